@@ -0,0 +1,150 @@
+import argparse
+import glob
+import os
+import sys
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from . import dctbackends, filesaver, tools
+from .progressive import SCAN_SCRIPTS
+from .quantization import DEFAULT_QUALITY
+
+IMAGE_EXTENSIONS = (".bmp", ".png", ".tif", ".tiff", ".jpg", ".jpeg", ".ppm", ".webp")
+# JPEGs are only encoded when named on their own, a directory or glob would otherwise pick up earlier outputs
+JPEG_EXTENSIONS = (".jpg", ".jpeg")
+
+def IsImage(path):
+    return os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS
+
+def IsExpandedImage(path):
+    return IsImage(path) and os.path.splitext(path)[1].lower() not in JPEG_EXTENSIONS
+
+def CollectJobs(inputs, outputDir=None):
+    # directories keep their layout under the output directory, files and globs land at its top
+    jobs = {}
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            for root, _, names in os.walk(pattern):
+                for name in sorted(names):
+                    path = os.path.join(root, name)
+                    if IsExpandedImage(path):
+                        jobs.setdefault(path, OutputAddr(path, os.path.relpath(path, pattern), outputDir))
+            continue
+
+        if os.path.isfile(pattern):
+            paths = [pattern]
+        else:
+            paths = sorted(glob.glob(pattern, recursive=True))
+            if not paths:
+                raise FileNotFoundError(f"No input matches: {pattern}")
+            paths = [path for path in paths if not path.lower().endswith(JPEG_EXTENSIONS)]
+        for path in paths:
+            if os.path.isfile(path):
+                jobs.setdefault(path, OutputAddr(path, os.path.basename(path), outputDir))
+
+    outputs = {}
+    for inputAddr, outputAddr in jobs.items():
+        if os.path.abspath(inputAddr) == os.path.abspath(outputAddr):
+            raise ValueError(f"Output would overwrite its input, pass an output directory: {inputAddr}")
+        if os.path.abspath(outputAddr) in outputs:
+            raise ValueError(f"{inputAddr} and {outputs[os.path.abspath(outputAddr)]} would both write {outputAddr}")
+        outputs[os.path.abspath(outputAddr)] = inputAddr
+
+    return list(jobs.items())
+
+def OutputAddr(inputAddr, relativeAddr, outputDir=None):
+    if outputDir is None:
+        return os.path.splitext(inputAddr)[0] + ".jpg"
+
+    return os.path.join(outputDir, os.path.splitext(relativeAddr)[0] + ".jpg")
+
+def IsUpToDate(inputAddr, outputAddr):
+    return os.path.exists(outputAddr) and os.path.getmtime(outputAddr) >= os.path.getmtime(inputAddr)
+
+def EncodeFile(inputAddr, outputAddr, options):
+    os.makedirs(os.path.dirname(outputAddr) or ".", exist_ok=True)
+
+    start = time.perf_counter()
+    inputSize, outputSize = tools.CompressionImg(inputAddr, outputAddr, **options)
+
+    return inputSize * 1024, outputSize * 1024, time.perf_counter() - start
+
+def PrintSummary(results, skipped, failed, elapsed):
+    if results:
+        inputBytes = sum(result[0] for result in results)
+        outputBytes = sum(result[1] for result in results)
+        latencies = np.array([result[2] for result in results])
+        p50, p95 = np.percentile(latencies, [50, 95])
+
+        print(f"encoded {len(results)} images in {elapsed:.2f} s: "
+              f"{inputBytes / 1e6 / elapsed:.2f} MB/s, {len(results) / elapsed:.2f} images/s, "
+              f"ratio {inputBytes / outputBytes:.2f}, p50 {p50 * 1000:.1f} ms, p95 {p95 * 1000:.1f} ms")
+    else:
+        print("encoded 0 images")
+
+    print(f"skipped {skipped} up to date, {len(failed)} failed")
+
+def ParseArgs(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m Model.batch", description="Encode images to JPEG in a process pool.")
+    parser.add_argument("inputs", nargs="+", help="image files, directories or glob patterns")
+    parser.add_argument("-o", "--output-dir", help="write outputs here instead of next to the inputs")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(), help="encoder processes (default: all cpus)")
+    parser.add_argument("-q", "--quality", type=int, default=DEFAULT_QUALITY, help=f"1 to 100 (default: {DEFAULT_QUALITY})")
+    parser.add_argument("--subsampling", choices=list(filesaver.SAMPLING_FACTORS), default="4:4:4")
+    parser.add_argument("--dct", choices=list(tools.DCT_ENGINES), default=dctbackends.DEFAULT_DCT,
+                        help=f"DCT backend (default: {dctbackends.DEFAULT_DCT}), auto measures the fastest on this host once; aan is the integer DCT with quantization folded in")
+    parser.add_argument("--progressive", nargs="?", const="spectral", default=False, choices=list(SCAN_SCRIPTS),
+                        help="write progressive JPEGs with this scan script (default: spectral)")
+    parser.add_argument("--optimize", action="store_true", help="build optimized Huffman tables")
+    parser.add_argument("--restart-interval", type=int, default=0, help="MCUs per restart interval")
+    parser.add_argument("--strip-rows", type=int, default=0, help="stream the image in strips of this many rows")
+    parser.add_argument("-f", "--force", action="store_true", help="encode even when the output is up to date")
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = ParseArgs(argv)
+    options = {
+        "optimize": args.optimize,
+        "restartInterval": args.restart_interval,
+        "stripRows": args.strip_rows,
+        "subsampling": args.subsampling,
+        "quality": args.quality,
+        # resolved once here, so the workers read the choice instead of each measuring the backends
+        "dct": dctbackends.ResolveBackend(args.dct),
+        "progressive": args.progressive,
+    }
+
+    try:
+        jobs = CollectJobs(args.inputs, args.output_dir)
+    except (FileNotFoundError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 2
+
+    pending = [(inputAddr, outputAddr) for inputAddr, outputAddr in jobs if args.force or not IsUpToDate(inputAddr, outputAddr)]
+    skipped = len(jobs) - len(pending)
+
+    results, failed = [], []
+    start = time.perf_counter()
+    # every image is encoded on one process, the pool spreads the images
+    with ProcessPoolExecutor(max(1, args.workers)) as pool:
+        futures = {pool.submit(EncodeFile, inputAddr, outputAddr, options): (inputAddr, outputAddr) for inputAddr, outputAddr in pending}
+        for future in as_completed(futures):
+            inputAddr, outputAddr = futures[future]
+            try:
+                inputBytes, outputBytes, seconds = future.result()
+            except Exception as e:
+                failed.append(inputAddr)
+                print(f"{inputAddr}: failed: {e}", file=sys.stderr)
+                continue
+
+            results.append((inputBytes, outputBytes, seconds))
+            print(f"{inputAddr} -> {outputAddr}: {inputBytes / 1024:.1f} KB -> {outputBytes / 1024:.1f} KB, "
+                  f"ratio {inputBytes / outputBytes:.2f}, {seconds * 1000:.1f} ms, {inputBytes / 1e6 / seconds:.2f} MB/s")
+
+    PrintSummary(results, skipped, failed, time.perf_counter() - start)
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,66 @@
+import struct
+import numpy as np
+
+BI_RGB = 0
+BI_BITFIELDS = 3
+
+# 32 bit pixels are stored as B, G, R, X; these are the only channel masks that layout allows
+BGRX_MASKS = (0x00FF0000, 0x0000FF00, 0x000000FF)
+
+class BmpImage:
+    def __init__(self, addr):
+        with open(addr, 'rb') as f:
+            fileHeader = f.read(14)
+            if len(fileHeader) < 14 or fileHeader[:2] != b'BM':
+                raise ValueError(f"Not a BMP file: {addr}")
+
+            dataOffset, = struct.unpack('<I', fileHeader[10:14])
+            headerSize, = struct.unpack('<I', f.read(4))
+            if headerSize < 40:
+                raise ValueError(f"Unsupported BMP header size: {headerSize}")
+
+            infoHeader = f.read(headerSize - 4)
+            width, height, _, bitCount, compression = struct.unpack('<iiHHI', infoHeader[:16])
+            masks = struct.unpack('<III', infoHeader[36:48]) if compression == BI_BITFIELDS and len(infoHeader) >= 48 else None
+            if compression == BI_BITFIELDS and masks is None:
+                masks = struct.unpack('<III', f.read(12))
+
+        if bitCount not in (24, 32) or compression not in (BI_RGB, BI_BITFIELDS):
+            raise ValueError(f"Unsupported BMP format: {bitCount} bit, compression {compression}")
+        if compression == BI_BITFIELDS and (bitCount != 32 or masks != BGRX_MASKS):
+            raise ValueError(f"Unsupported BMP channel masks: {masks}")
+
+        self.width = width
+        self.height = abs(height)
+        self.bottomUp = height > 0
+        self.bytesPerPixel = bitCount // 8
+        # rows are padded to a multiple of 4 bytes
+        self.stride = (bitCount * width + 31) // 32 * 4
+
+        self.raw = np.memmap(addr, dtype=np.uint8, mode='r', offset=dataOffset, shape=(self.height * self.stride,))
+        # pixels in file order: BGR, rows as stored, row padding skipped through the strides
+        self.bgr = np.lib.stride_tricks.as_strided(self.raw, shape=(self.height, self.width, 3), strides=(self.stride, self.bytesPerPixel, 1), writeable=False)
+
+    @property
+    def rgb(self) -> np.ndarray:
+        # top-down RGB view of the same pages, no pixel is copied
+        rows = self.bgr[::-1] if self.bottomUp else self.bgr
+
+        return rows[:, :, ::-1]
+
+def IsBmp(addr) -> bool:
+    with open(addr, 'rb') as f:
+        return f.read(2) == b'BM'
+
+def ReadBmp(addr) -> np.ndarray:
+    return BmpImage(addr).rgb
+
+def TryReadBmp(addr):
+    # None for anything that is not an uncompressed 24 or 32 bit BMP
+    if not IsBmp(addr):
+        return None
+
+    try:
+        return ReadBmp(addr)
+    except ValueError:
+        return None
@@ -0,0 +1,60 @@
+import numpy as np
+from functools import lru_cache
+
+# RGB to YCbCr in 16 bit fixed point, laid out like libjpeg's jccolor: every channel value looks up its share of
+# Y, Cb and Cr in a table, so a pixel costs three gathers and two additions instead of a float64 matrix product.
+# The rounding constant and the level shift are folded into the red table; chroma adds one less than a half,
+# which keeps the largest value at 127 without a clip. The output is int8, every sample already shifted by -128
+# for the DCT; against the float conversion every sample is equal or off by one, where the float result lands
+# next to a rounding boundary.
+
+SCALE_BITS = 16
+ONE_HALF = 1 << (SCALE_BITS - 1)
+# pixels per chunk, the int32 accumulator of a chunk stays around 768 KB
+CHUNK_PIXELS = 1 << 16
+
+RGB_TO_YCBCR = np.array([
+    [    0.299,     0.587,     0.114],
+    [-0.168736, -0.331264,       0.5],
+    [      0.5, -0.418688, -0.081312]])
+
+@lru_cache(maxsize=None)
+def ConversionTables() -> np.ndarray:
+    # (3, 256, 3): for the R, G and B value, its fixed point contribution to Y, Cb and Cr
+    fixed = np.round(RGB_TO_YCBCR * (1 << SCALE_BITS)).astype(np.int32)
+    tables = np.arange(256, dtype=np.int32)[None, :, None] * fixed.T[:, None, :]
+    # Y is shifted down by 128 while Cb and Cr skip their offset of 128, so all three are centred on 0
+    tables[0] += np.array([ONE_HALF - (128 << SCALE_BITS), ONE_HALF - 1, ONE_HALF - 1], dtype=np.int32)
+    tables.setflags(write=False)
+
+    return tables
+
+def ConvertChunk(rgb: np.ndarray, out: np.ndarray, accumulator: np.ndarray):
+    redTable, greenTable, blueTable = ConversionTables()
+    np.take(redTable, rgb[:, :, 0], axis=0, out=accumulator)
+    accumulator += greenTable[rgb[:, :, 1]]
+    accumulator += blueTable[rgb[:, :, 2]]
+    np.right_shift(accumulator, SCALE_BITS, out=accumulator)
+    out[...] = accumulator
+
+def RgbToYCbCr(rgbImg: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    # a few rows at a time into one int8 output, which may be given to reuse a buffer
+    height, width = rgbImg.shape[:2]
+    if out is None:
+        out = np.empty((height, width, 3), dtype=np.int8)
+
+    chunkRows = max(1, CHUNK_PIXELS // max(width, 1))
+    accumulator = np.empty((min(chunkRows, height), width, 3), dtype=np.int32)
+    for start in range(0, height, chunkRows):
+        stop = min(start + chunkRows, height)
+        ConvertChunk(rgbImg[start:stop], out[start:stop], accumulator[:stop - start])
+
+    return out
+
+def LevelShift(grayImg: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    # flipping the top bit of a uint8 and reading it as int8 subtracts 128
+    if out is None:
+        out = np.empty(grayImg.shape, dtype=np.int8)
+    np.bitwise_xor(grayImg, 0x80, out=out.view(np.uint8))
+
+    return out
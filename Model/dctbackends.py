@@ -0,0 +1,140 @@
+import importlib.util
+import json
+import os
+import platform
+import time
+import numpy as np
+from functools import lru_cache
+
+# every backend takes the (count, 8, 8, channels) blocks of SplitMCUs and returns their orthonormal 2D DCT as
+# float32 in the same layout; the module behind a backend is only imported the first time it runs
+BACKENDS = {}
+BACKEND_MODULES = {"cv2": "cv2", "numpy": "numpy", "scipy": "scipy"}
+
+# what every encode uses unless it asks for another backend, or for auto to measure them
+DEFAULT_DCT = "cv2"
+
+BENCHMARK_BLOCKS = 4096
+BENCHMARK_REPEAT = 3
+
+def Backend(name):
+    def register(func):
+        BACKENDS[name] = func
+        return func
+
+    return register
+
+@Backend("cv2")
+def Cv2DCT(blocks: np.ndarray) -> np.ndarray:
+    import cv2
+
+    # 2D DCT as two passes of cv2's 1D row transform over every block at once
+    count, _, _, channels = blocks.shape
+    rowsFirst = np.float32(blocks.transpose(0, 3, 1, 2)).reshape(-1, 8)
+    rowsFirst = cv2.dct(rowsFirst, flags=cv2.DCT_ROWS).reshape(-1, 8, 8)
+    colsSecond = np.ascontiguousarray(rowsFirst.swapaxes(1, 2)).reshape(-1, 8)
+    colsSecond = cv2.dct(colsSecond, flags=cv2.DCT_ROWS).reshape(count, channels, 8, 8)
+
+    return colsSecond.transpose(0, 3, 2, 1)
+
+@lru_cache(maxsize=None)
+def BlockDCTMatrix() -> np.ndarray:
+    # the 2D DCT of a flattened block is one product with the Kronecker square of the 8 point DCT matrix
+    k = np.arange(8)
+    matrix = np.sqrt(2 / 8) * np.cos((2 * k[None, :] + 1) * k[:, None] * np.pi / 16)
+    matrix[0] /= np.sqrt(2)
+    blockMatrix = np.ascontiguousarray(np.kron(matrix, matrix).T, dtype=np.float32)
+    blockMatrix.setflags(write=False)
+
+    return blockMatrix
+
+@Backend("numpy")
+def NumpyDCT(blocks: np.ndarray) -> np.ndarray:
+    # every block of the image goes through a single matrix multiply
+    count, _, _, channels = blocks.shape
+    flat = np.float32(blocks.transpose(0, 3, 1, 2)).reshape(-1, 64)
+
+    return (flat @ BlockDCTMatrix()).reshape(count, channels, 8, 8).transpose(0, 2, 3, 1)
+
+@Backend("scipy")
+def ScipyDCT(blocks: np.ndarray) -> np.ndarray:
+    from scipy.fft import dctn
+
+    return dctn(np.float32(blocks), type=2, axes=(1, 2), norm="ortho")
+
+def IsAvailable(name) -> bool:
+    # finds the module without importing it
+    return importlib.util.find_spec(BACKEND_MODULES[name]) is not None
+
+def CachePath():
+    cacheHome = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+
+    return os.path.join(cacheHome, "jpegencoder", "dct.json")
+
+def HostKey():
+    # a choice is only reused on the machine and the numpy it was measured with
+    return f"{platform.node()}|{platform.machine()}|{os.cpu_count()}|{platform.python_version()}|{np.__version__}"
+
+def BenchmarkBackends(names) -> dict:
+    blocks = np.random.default_rng(0).integers(0, 256, (BENCHMARK_BLOCKS, 8, 8, 3), dtype=np.uint8)
+    seconds = {}
+    for name in names:
+        # the first call pays for the import and is not timed
+        BACKENDS[name](blocks)
+        times = []
+        for _ in range(BENCHMARK_REPEAT):
+            start = time.perf_counter()
+            BACKENDS[name](blocks)
+            times.append(time.perf_counter() - start)
+        seconds[name] = min(times)
+
+    return seconds
+
+def ReadCachedChoice():
+    try:
+        with open(CachePath()) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    name = cached.get(HostKey()) if isinstance(cached, dict) else None
+
+    return name if name in BACKENDS and IsAvailable(name) else None
+
+def WriteCachedChoice(name):
+    path = CachePath()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            with open(path) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            cached = {}
+        cached = cached if isinstance(cached, dict) else {}
+        cached[HostKey()] = name
+
+        # written aside and moved in, so a concurrent reader never sees half a file
+        tmpPath = f"{path}.{os.getpid()}.tmp"
+        with open(tmpPath, "w") as f:
+            json.dump(cached, f, indent=2)
+        os.replace(tmpPath, path)
+    except OSError:
+        # a read-only home only costs the benchmark again next time
+        pass
+
+@lru_cache(maxsize=None)
+def AutoBackend() -> str:
+    # measured once per host and remembered on disk, later processes only import the winner
+    name = ReadCachedChoice()
+    if name is None:
+        seconds = BenchmarkBackends([name for name in BACKENDS if IsAvailable(name)])
+        name = min(seconds, key=seconds.get)
+        WriteCachedChoice(name)
+
+    return name
+
+def ResolveBackend(backend = "auto") -> str:
+    return AutoBackend() if backend == "auto" else backend
+
+def TransformDCTBlocks(blocks: np.ndarray, backend = DEFAULT_DCT) -> np.ndarray:
+    return BACKENDS[ResolveBackend(backend)](blocks)
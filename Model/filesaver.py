@@ -1,7 +1,27 @@
+import errno
+import io
+import os
+import struct
+import uuid
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import chain
 from bitarray import bitarray
 import numpy as np
 from collections import Counter, OrderedDict
-from .huffman import HuffmanTable
+from .huffman import DEFAULT_HUFFMAN_TABLE, HuffmanTable
+from .entropy import RestartMarker
+from .quantization import DQTPayload, QuantizationTable, QuantizationTables
+
+HEADER_CACHE_SIZE = 32
+WRITE_BUFFER_SIZE = 1 << 20
+
+# horizontal and vertical sampling factors of the luminance component, chrominance is always 1x1
+SAMPLING_FACTORS = {
+    "4:4:4": (1, 1),
+    "4:2:2": (2, 1),
+    "4:2:0": (2, 2),
+}
 
 def WriteAPP0(f):
     f.write(b'\xff\xe0')  
@@ -29,40 +49,19 @@ def WriteHuffmanTable(f, huff_table: OrderedDict, table_class, destination_id):
     for key, _ in huff_table.items(): 
         f.write(key.to_bytes(1, 'big'))
 
-def WriteQuantizationTable(f, quant_table: np.ndarray, table_id):
+def WriteQuantizationTable(f, quant_table, table_id):
     f.write(b'\xFF\xDB')
 
     f.write((67).to_bytes(2, 'big'))
     f.write((0 << 4 | table_id).to_bytes(1, 'big'))
 
-    direction = 1
-    rows, cols = quant_table.shape
-    row, col = 0, 0
-    for _ in range(quant_table.size):
-        f.write(int(quant_table[row, col]).to_bytes(1, 'big'))
-        if direction == 1:
-            if col == cols - 1:
-                row += 1
-                direction = -1
-            elif row == 0:
-                col += 1
-                direction = -1
-            else:
-                row -= 1
-                col += 1
-        else:
-            if row == rows - 1:
-                col += 1
-                direction = 1
-            elif col == 0:
-                row += 1
-                direction = 1
-            else:
-                row += 1
-                col -= 1
-
-def WriteStartOfFrame(f, image_width, image_height, num_components):
-    f.write(b'\xFF\xC0')
+    # cached tables carry their zig-zag ordered payload already
+    payload = quant_table.payload if isinstance(quant_table, QuantizationTable) else DQTPayload(quant_table)
+    f.write(payload)
+
+def WriteStartOfFrame(f, image_width, image_height, num_components, luma_sampling=(1, 1), progressive=False):
+    # SOF2 for a progressive frame, SOF0 for a baseline one
+    f.write(b'\xFF\xC2' if progressive else b'\xFF\xC0')
     f.write((8 + 3 * num_components).to_bytes(2, 'big'))
     
     f.write((8).to_bytes(1, 'big'))
@@ -73,12 +72,20 @@ def WriteStartOfFrame(f, image_width, image_height, num_components):
     for i in range(1, num_components + 1):
         f.write((i).to_bytes(1, 'big'))
         if i == 1:
-            f.write((0x11).to_bytes(1, 'big'))
+            f.write((luma_sampling[0] << 4 | luma_sampling[1]).to_bytes(1, 'big'))
             f.write((0).to_bytes(1, 'big'))
         else:
             f.write((0x11).to_bytes(1, 'big'))
             f.write((1).to_bytes(1, 'big'))
         
+def WriteRestartInterval(f, restart_interval):
+    if not 0 < restart_interval <= 0xFFFF:
+        raise ValueError(f"restart interval should be between 1 and 65535 MCUs: {restart_interval}")
+
+    f.write(b'\xFF\xDD')
+    f.write((4).to_bytes(2, 'big'))
+    f.write(restart_interval.to_bytes(2, 'big'))
+
 def WriteStartOfScan(f, num_components):
     f.write(b'\xFF\xDA')
     f.write((6 + 2 * num_components).to_bytes(2, 'big'))
@@ -96,6 +103,21 @@ def WriteStartOfScan(f, num_components):
     f.write((63).to_bytes(1, 'big'))
     f.write((0).to_bytes(1, 'big'))
 
+def WriteProgressiveScanHeader(f, components, table_ids, start, end, high, low):
+    f.write(b'\xFF\xDA')
+    f.write((6 + 2 * len(components)).to_bytes(2, 'big'))
+
+    f.write(len(components).to_bytes(1, 'big'))
+
+    # a DC scan only reads the DC selector and an AC scan the AC one, both point at the component's table
+    for component, table_id in zip(components, table_ids):
+        f.write((component + 1).to_bytes(1, 'big'))
+        f.write((table_id << 4 | table_id).to_bytes(1, 'big'))
+
+    f.write(start.to_bytes(1, 'big'))
+    f.write(end.to_bytes(1, 'big'))
+    f.write((high << 4 | low).to_bytes(1, 'big'))
+
 def WriteCompressedData(f, encoded_dc, encoded_ac):
     buffer = ''
 
@@ -157,8 +179,9 @@ def CalHTBitLength(huff_table: OrderedDict):
     for _ , code in huff_table.items():
         length = len(code)
 
-        if length <= 16:
-            length_counts[length - 1] += 1
+        if not 1 <= length <= 16:
+            raise ValueError(f"Huffman code length should be between 1 and 16: {length}")
+        length_counts[length - 1] += 1
             
     record = bytearray(length_counts)
     bit_array = bitarray()
@@ -166,25 +189,163 @@ def CalHTBitLength(huff_table: OrderedDict):
     
     return bit_array
 
-def WriteJpeg(bitStream: bitarray, tables:HuffmanTable, quant_table_luminance, quant_table_chrominance, image_height, image_width, addr):
-    with open(addr, 'wb') as f:
-        f.write(b'\xff\xd8')
+def StuffBytes(chunk: bytes) -> bytes:
+    return chunk.replace(b'\xff', b'\xff\x00')
 
-        # Check X,Y pixel density
-        WriteAPP0(f)
-        
-        WriteQuantizationTable(f, quant_table_luminance, 0)
-        WriteQuantizationTable(f, quant_table_chrominance, 1)
+def StuffScan(scanChunks, stats=None):
+    # every 0xFF inside the entropy coded segment is followed by a stuffed 0x00
+    if stats is None:
+        for chunk in scanChunks:
+            yield chunk if isinstance(chunk, RestartMarker) else StuffBytes(chunk)
+        return
 
-        WriteStartOfFrame(f, image_width, image_height, 3)
+    for chunk in scanChunks:
+        if isinstance(chunk, RestartMarker):
+            stats.markerBytes += len(chunk)
+        else:
+            stats.stuffingBytes += chunk.count(b'\xff')
+            chunk = StuffBytes(chunk)
+        stats.scanBytes += len(chunk)
+        yield chunk
 
-        WriteHuffmanTable(f, tables.dcLuminanceCodes, 0, 0)  # DC Huffman table for Y
-        WriteHuffmanTable(f, tables.acLuminanceCodes, 1, 0)  # AC Huffman table for Y
-        WriteHuffmanTable(f, tables.dcChrominanceCodes, 0, 1)  # DC Huffman table for Cb/Cr
-        WriteHuffmanTable(f, tables.acChrominanceCodes, 1, 1)  # AC Huffman table for Cb/Cr
-        
-        WriteStartOfScan(f, 3)
+def BuildHeader(tables:HuffmanTable, quant_table_luminance, quant_table_chrominance, restartInterval=0, subsampling="4:4:4", num_components=3) -> tuple:
+    # everything from SOI to SOS, with zero dimensions in SOF and the offset they go to
+    header = io.BytesIO()
+    header.write(b'\xff\xd8')
+
+    # Check X,Y pixel density
+    WriteAPP0(header)
+
+    # a grayscale image only refers to the luminance tables
+    WriteQuantizationTable(header, quant_table_luminance, 0)
+    if num_components > 1:
+        WriteQuantizationTable(header, quant_table_chrominance, 1)
+
+    dimensionOffset = header.tell() + 5
+    WriteStartOfFrame(header, 0, 0, num_components, SAMPLING_FACTORS[subsampling])
+
+    WriteHuffmanTable(header, tables.dcLuminanceCodes, 0, 0)  # DC Huffman table for Y
+    WriteHuffmanTable(header, tables.acLuminanceCodes, 1, 0)  # AC Huffman table for Y
+    if num_components > 1:
+        WriteHuffmanTable(header, tables.dcChrominanceCodes, 0, 1)  # DC Huffman table for Cb/Cr
+        WriteHuffmanTable(header, tables.acChrominanceCodes, 1, 1)  # AC Huffman table for Cb/Cr
+
+    if restartInterval > 0:
+        WriteRestartInterval(header, restartInterval)
+
+    WriteStartOfScan(header, num_components)
+
+    return header.getvalue(), dimensionOffset
+
+@lru_cache(maxsize=HEADER_CACHE_SIZE)
+def HeaderTemplate(quality, restartInterval=0, subsampling="4:4:4", num_components=3) -> tuple:
+    # only the default Huffman tables and the standard quantization tables are cached, both are fixed by the key
+    return BuildHeader(DEFAULT_HUFFMAN_TABLE, *QuantizationTables(quality), restartInterval, subsampling, num_components)
+
+def TemplateQuality(tables:HuffmanTable, quant_table_luminance, quant_table_chrominance):
+    if tables is not DEFAULT_HUFFMAN_TABLE:
+        return None
+    if not isinstance(quant_table_luminance, QuantizationTable) or not isinstance(quant_table_chrominance, QuantizationTable):
+        return None
+    if quant_table_luminance.quality is None or quant_table_luminance.quality != quant_table_chrominance.quality:
+        return None
+
+    return quant_table_luminance.quality
+
+def JpegHeader(tables:HuffmanTable, quant_table_luminance, quant_table_chrominance, image_height, image_width, restartInterval=0, subsampling="4:4:4", num_components=3) -> bytearray:
+    quality = TemplateQuality(tables, quant_table_luminance, quant_table_chrominance)
+    if quality is None:
+        template, dimensionOffset = BuildHeader(tables, quant_table_luminance, quant_table_chrominance, restartInterval, subsampling, num_components)
+    else:
+        template, dimensionOffset = HeaderTemplate(quality, restartInterval, subsampling, num_components)
+
+    header = bytearray(template)
+    struct.pack_into('>HH', header, dimensionOffset, image_height, image_width)
+
+    return header
+
+def WritePieces(f, pieces) -> int:
+    # the pieces are gathered into writes of WRITE_BUFFER_SIZE or more, a small image goes out in one
+    buffer, buffered, written = [], 0, 0
+    for piece in pieces:
+        buffer.append(piece)
+        buffered += len(piece)
+        if buffered >= WRITE_BUFFER_SIZE:
+            f.write(b''.join(buffer))
+            written += buffered
+            buffer, buffered = [], 0
+
+    f.write(b''.join(buffer))
+
+    return written + buffered
+
+def WriteJpegTo(f, scanChunks, tables:HuffmanTable, quant_table_luminance, quant_table_chrominance, image_height, image_width, restartInterval=0, subsampling="4:4:4", quality=None, stats=None, num_components=3) -> int:
+    # a quality picks the scaled standard tables instead of the given ones
+    if quality is not None:
+        quant_table_luminance, quant_table_chrominance = QuantizationTables(quality)
+
+    header = JpegHeader(tables, quant_table_luminance, quant_table_chrominance, image_height, image_width, restartInterval, subsampling, num_components)
+    written = WritePieces(f, chain([header], StuffScan(scanChunks, stats), [b'\xff\xd9']))
+
+    if stats is not None:
+        stats.fileBytes = written
+        stats.headerBytes = written - stats.scanBytes
+
+    return written
+
+@contextmanager
+def OutputFile(addr):
+    # written aside and moved over addr once complete: a failed encode leaves whatever was at addr untouched, and
+    # an input mapped from the same path keeps reading the old file until the move
+    if os.path.exists(addr):
+        # a file that may not be written fails here like open would, instead of being replaced
+        open(addr, 'r+b').close()
+    directory, name = os.path.split(os.path.abspath(addr))
+    if not os.path.isdir(directory):
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), addr)
+    tmpAddr = os.path.join(directory, f".{name}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp")
+    # os.open applies the umask like a plain open
+    f = os.fdopen(os.open(tmpAddr, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o666), 'wb')
+    try:
+        with f:
+            yield f
+        os.replace(tmpAddr, addr)
+    except BaseException:
+        os.remove(tmpAddr)
+        raise
+
+def WriteJpeg(scanChunks, tables:HuffmanTable, quant_table_luminance, quant_table_chrominance, image_height, image_width, addr, restartInterval=0, subsampling="4:4:4", quality=None, stats=None, num_components=3) -> int:
+    # the scan may still be produced while it is written, a failure there must not leave half a file
+    with OutputFile(addr) as f:
+        return WriteJpegTo(f, scanChunks, tables, quant_table_luminance, quant_table_chrominance, image_height, image_width, restartInterval, subsampling, quality, stats, num_components)
+
+def ProgressivePieces(encodedScans, quant_table_luminance, quant_table_chrominance, image_height, image_width, subsampling="4:4:4", num_components=3, stats=None):
+    header = io.BytesIO()
+    header.write(b'\xff\xd8')
+    WriteAPP0(header)
+    WriteQuantizationTable(header, quant_table_luminance, 0)
+    if num_components > 1:
+        WriteQuantizationTable(header, quant_table_chrominance, 1)
+    WriteStartOfFrame(header, image_width, image_height, num_components, SAMPLING_FACTORS[subsampling], progressive=True)
+    yield header.getvalue()
+
+    # every scan brings the Huffman tables it was coded with, right before its own header
+    for encodedScan in encodedScans:
+        scanHeader = io.BytesIO()
+        for table_class, destination_id, codes in encodedScan.huffmanTables:
+            WriteHuffmanTable(scanHeader, codes, table_class, destination_id)
+        scan = encodedScan.scan
+        WriteProgressiveScanHeader(scanHeader, scan.components, encodedScan.tableIds, scan.start, scan.end, scan.high, scan.low)
+        yield scanHeader.getvalue()
+        yield from StuffScan(encodedScan.chunks, stats)
+
+    yield b'\xff\xd9'
+
+def WriteProgressiveJpegTo(f, encodedScans, quant_table_luminance, quant_table_chrominance, image_height, image_width, subsampling="4:4:4", num_components=3, stats=None) -> int:
+    written = WritePieces(f, ProgressivePieces(encodedScans, quant_table_luminance, quant_table_chrominance, image_height, image_width, subsampling, num_components, stats))
 
-        f.write(bitStream.tobytes())
+    if stats is not None:
+        stats.fileBytes = written
+        stats.headerBytes = written - stats.scanBytes
 
-        f.write(b'\xff\xd9')
\ No newline at end of file
+    return written
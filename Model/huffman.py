@@ -1,7 +1,8 @@
 from heapq import heappop, heappush, heapify
 from collections import defaultdict, OrderedDict
-from bitarray import bitarray
 import numpy as np
+from .entropy import BitPacker, BuildCodeLookup, EncodeScanChunks, PadScan, EncodeSegments, RestartMarker, UNITS_PER_CHUNK
+from .statistics import CalSymbolStatistics
 
 # defualt huffman table
 DCLuminanceCodes = defaultdict(lambda: str, {
@@ -364,6 +365,11 @@ ACChrominanceCodes = defaultdict(lambda: str, {
     250: '1111111111111110'
 })
 
+RESERVED_SYMBOL = 256
+
+# table id of each component: luminance, then both chrominance components
+COMPONENT_TABLES = np.array([0, 1, 1])
+
 class Node:
     def __init__(self, char, freq):
         self.char = char
@@ -396,6 +402,58 @@ def build_codes(node, codebook: defaultdict, prefix=''):
         build_codes(node.right, codebook, prefix + '1')
     return codebook
 
+def limit_code_lengths(code_lengths: dict, max_length=16) -> OrderedDict:
+    # JPEG Annex K.3: fold codes longer than max_length back into the tree, then drop the reserved code word
+    symbols = sorted(code_lengths, key=lambda symbol: (code_lengths[symbol], symbol))
+    bits = [0] * (max(max(code_lengths.values()), max_length) + 1)
+    for length in code_lengths.values():
+        bits[length] += 1
+
+    for i in range(len(bits) - 1, max_length, -1):
+        while bits[i] > 0:
+            j = i - 2
+            while bits[j] == 0:
+                j -= 1
+
+            bits[i] -= 2
+            bits[i - 1] += 1
+            bits[j + 1] += 2
+            bits[j] -= 1
+
+    i = max_length
+    while bits[i] == 0:
+        i -= 1
+    bits[i] -= 1
+
+    lengths = []
+    for length in range(1, max_length + 1):
+        lengths += [length] * bits[length]
+
+    return OrderedDict(zip(symbols[:-1], lengths))
+
+def build_canonical_codes(code_lengths: OrderedDict) -> OrderedDict:
+    # JPEG Annex C: consecutive code words per length, in the order the symbols go into the DHT segment
+    codes = OrderedDict()
+    code = 0
+    previous_length = 0
+
+    for symbol, length in code_lengths.items():
+        code <<= length - previous_length
+        codes[symbol] = format(code, f'0{length}b')
+        code += 1
+        previous_length = length
+
+    return codes
+
+def build_optimal_codes(frequencies: dict) -> OrderedDict:
+    # the reserved symbol is the rarest one, so it takes the all ones code word that JPEG forbids
+    root = build_huffman_tree({**frequencies, RESERVED_SYMBOL: 0})
+    codes = defaultdict(str)
+    build_codes(root, codes)
+    code_lengths = limit_code_lengths({symbol: len(code) for symbol, code in codes.items()})
+
+    return build_canonical_codes(code_lengths)
+
 def reset_huffman_tree(node):
     if node:
         node.char = None
@@ -404,189 +462,93 @@ def reset_huffman_tree(node):
         reset_huffman_tree(node.right)
 
 class Huffman:
-    def __init__(self, dcMatrix, acMatrix):
+    def __init__(self, dcMatrix, acMatrix, components=(0, 1, 2)):
         self.dcMatrix = dcMatrix
         self.acMatrix = acMatrix
+        # the component of every block column, in MCU order
+        self.components = components
 
-    def __huffman_encoding(self, valList, isDC=True):
-        frequencies = self.__CalDCCodingCategory(valList) if isDC else self.__CalACCodeingCategory(valList)
-        
-        root = build_huffman_tree(frequencies)
-        codes = defaultdict(str)
-        build_codes(root, codes)
-        sorted_codes = OrderedDict(sorted(codes.items(), key=lambda item: len(item[1])))
-    
-        return sorted_codes
-
-    def __CalDCCodingCategory(self, valList):
-        length_count = {}
-        for value in valList:
-            bit_length = int(value).bit_length()
-            if bit_length in length_count:
-                length_count[bit_length] += 1
-            else:
-                length_count[bit_length] = 1        
-
-        return length_count
-
-    def __CalACCodeingCategory(self, valMatrix):
-        freq_dict = {}
-
-        for block in valMatrix:
-            run_length = 0
-
-            for i in range(1, len(block)):
-                val = block[i]
-                
-                if val == 0:
-                    run_length += 1
-
-                    if run_length > 15:
-                        run_size_pair = 0xF0
-                        if run_size_pair in freq_dict:
-                            freq_dict[run_size_pair] += 1
-                        else:
-                            freq_dict[run_size_pair] = 1
-
-                        run_length = 0
-
-                else:
-                    size = int(np.ceil(np.log2(abs(val) + 1)))
-                    run_size_pair = (run_length << 4) | size
-
-                    if run_size_pair in freq_dict:
-                        freq_dict[run_size_pair] += 1
-                    else:
-                        freq_dict[run_size_pair] = 1
-
-                    run_length = 0
-            
-            if run_length > 0:
-                run_size_pair = 0
-                if run_size_pair in freq_dict:
-                    freq_dict[run_size_pair] += 1
-                else:
-                    freq_dict[run_size_pair] = 1
-
-        return freq_dict
-
-    def __EncodeDC(self, bitStream: bitarray, dcVal, codes):
-        if dcVal == 0:
-            huffman_code = codes.get(0, '')
-            bitStream.extend(bitarray(huffman_code))
-            return
-        
-        bit_length = int(dcVal).bit_length()
-        huffman_code = codes.get(bit_length, '')
-
-        if(dcVal<0):
-            codeList = list(bin(dcVal)[3:])
-            for i in range(len(codeList)):
-                if (codeList[i] == '0'):
-                    codeList[i] = 1
-                else:
-                    codeList[i] = 0
-        else:
-            codeList = list(bin(dcVal)[2:])
-            for i in range(len(codeList)):
-                if (codeList[i] == '0'):
-                    codeList[i] = 0
-                else:
-                    codeList[i] = 1
-
-        huffman_code += ''.join(map(str, codeList))
-        bitStream.extend(bitarray(huffman_code))
-            
-    def __EncodeAC(self, bitStream: bitarray, acList, codes):
-        run_length = 0
-        last_non_zero_index = np.where(acList == 1)[0][-1] if 1 in acList else 0
-
-        for i in range(0,  last_non_zero_index + 1):
-            val = acList[i]
-            
-            if val == 0:
-                run_length += 1
-
-                if run_length > 15:
-                    run_size_pair = 0xF0
-                    if run_size_pair in codes:
-                        bitStream.extend(codes[run_size_pair])
-                    else:
-                        raise ValueError(f"Not find: {run_size_pair}")
-
-                    run_length = 0
-            else:
-                size = int(np.ceil(np.log2(abs(val) + 1)))
-                run_size_pair = (run_length << 4) | size
-
-                if run_size_pair in codes:
-                    bitStream.extend(codes[run_size_pair])
-                else:
-                    raise ValueError(f"Not find: {run_size_pair}")
-
-                if val > 0:
-                    bitStream.extend(bin(val)[2:].zfill(size))
-                else:
-                    abs_value = abs(val)
-                    binary_str = format(abs_value, f'0{size}b')
-                    complement_str = ''.join('1' if bit == '0' else '0' for bit in binary_str)
-                    bitStream.extend(complement_str)
-
-                run_length = 0
-
-        if last_non_zero_index < len(acList) - 1:
-            bitStream.extend(codes[0])        
-
-    def __padding(self, bitStream: bitarray, padding_char='1'):
-        padding_size = 8 - (len(bitStream) % 8)
-        bitStream.extend(padding_char * padding_size)
-
-    def CalDCACCode(self, useDefault): 
+    def __huffman_encoding(self, frequencies):
+        return build_optimal_codes(frequencies)
+
+    def CalDCACCode(self, useDefault, statistics=None): 
         if useDefault:
-            return HuffmanTable(DCLuminanceCodes, ACLuminanceCodes, DCChrominanceCodes, ACChrominanceCodes)
+            return DEFAULT_HUFFMAN_TABLE
+
+        if statistics is None:
+            statistics = CalSymbolStatistics(self.dcMatrix, self.acMatrix, self.components)
 
-        dcLuminanceCodes = self.__huffman_encoding(self.dcMatrix[:, 0], isDC=True)
-        acLuminanceCodes = self.__huffman_encoding(self.acMatrix[:, 0, :], isDC=False)
+        dcLuminanceCodes = self.__huffman_encoding(statistics.Frequencies([0], isDC=True))
+        acLuminanceCodes = self.__huffman_encoding(statistics.Frequencies([0], isDC=False))
 
-        dcChrominanceCodes = self.__huffman_encoding(self.dcMatrix[:, 1] + self.dcMatrix[:, 2], isDC=True)
-        acChrominanceCodes = self.__huffman_encoding(self.acMatrix[:, 1, :] + self.acMatrix[:, 2, :], isDC=False)
+        # a grayscale scan never uses the chrominance tables, so they keep the defaults and are not written
+        if max(self.components) == 0:
+            return HuffmanTable(dcLuminanceCodes, acLuminanceCodes, DCChrominanceCodes, ACChrominanceCodes)
+
+        dcChrominanceCodes = self.__huffman_encoding(statistics.Frequencies([1, 2], isDC=True))
+        acChrominanceCodes = self.__huffman_encoding(statistics.Frequencies([1, 2], isDC=False))
 
         return HuffmanTable(dcLuminanceCodes, acLuminanceCodes, dcChrominanceCodes, acChrominanceCodes)
 
-    def EncodeDCAC(self, useDefault):
-        bitStream = bitarray()
-        tables = self.CalDCACCode(useDefault)
-        
-        for i in range(self.dcMatrix.shape[0]):
-            # luminance
-            self.__EncodeDC(bitStream, self.dcMatrix[i, 0], tables.dcLuminanceCodes)
-            self.__EncodeAC(bitStream, self.acMatrix[i, 0, :], tables.acLuminanceCodes)
-
-            # chrominance
-            self.__EncodeDC(bitStream, self.dcMatrix[i, 1], tables.dcChrominanceCodes)
-            self.__EncodeAC(bitStream, self.acMatrix[i, 1, :], tables.acChrominanceCodes)
-            self.__EncodeDC(bitStream, self.dcMatrix[i, 2], tables.dcChrominanceCodes)
-            self.__EncodeAC(bitStream, self.acMatrix[i, 2, :], tables.acChrominanceCodes)
-            
-        # handle FF00
-        self.__padding(bitStream)
-        byteStream = bitStream.tobytes()
-
-        i = 0
-        while i < len(byteStream):
-            if byteStream[i] == 0xFF:
-                byteStream = byteStream[:i+1] + b'\x00' + byteStream[i+1:]
-                i += 1
-            i += 1
-
-        bitStream = bitarray()
-        bitStream.frombytes(byteStream)
-
-        return bitStream, tables
+    def __CalLookups(self, tables):
+        dcLookup, acLookup = tables.CalLookups()
+        tableIds = np.tile(COMPONENT_TABLES[list(self.components)], self.dcMatrix.shape[0])
+
+        return dcLookup, acLookup, tableIds
+
+    def __EncodeScan(self, tables):
+        dcLookup, acLookup, tableIds = self.__CalLookups(tables)
+        packer = BitPacker()
+
+        yield from EncodeScanChunks(self.dcMatrix.reshape(-1), self.acMatrix.reshape(-1, self.acMatrix.shape[-1]), tableIds, dcLookup, acLookup, packer)
+        yield PadScan(packer)
+
+    def __EncodeRestartScan(self, tables, restartInterval):
+        dcLookup, acLookup, tableIds = self.__CalLookups(tables)
+        dcValues = self.dcMatrix.reshape(-1)
+        acValues = self.acMatrix.reshape(-1, self.acMatrix.shape[-1])
+
+        # whole restart intervals at a time, so no chunk ever splits a segment; parallel encoding of the segments
+        # lives in parallel.EncodeParallel
+        unitsPerSegment = restartInterval * self.dcMatrix.shape[1]
+        unitsPerTask = max(1, UNITS_PER_CHUNK // unitsPerSegment) * unitsPerSegment
+
+        index = 0
+        for start in range(0, dcValues.shape[0], unitsPerTask):
+            stop = start + unitsPerTask
+            for segment in EncodeSegments(dcValues[start:stop], acValues[start:stop], tableIds[start:stop], dcLookup, acLookup, unitsPerSegment):
+                if index > 0:
+                    yield RestartMarker.ForInterval(index - 1)
+                yield segment
+                index += 1
+
+    def EncodeDCAC(self, useDefault, restartInterval=0, statistics=None):
+        # the scan is produced lazily, chunk by chunk, and is not byte stuffed yet
+        tables = self.CalDCACCode(useDefault, statistics)
+
+        if restartInterval > 0:
+            return self.__EncodeRestartScan(tables, restartInterval), tables
+
+        return self.__EncodeScan(tables), tables
     
 class HuffmanTable:
     def __init__(self, dcLuminanceCodes: defaultdict, acLuminanceCodes: defaultdict, dcChrominanceCodes: defaultdict, acChrominanceCodes: defaultdict):
         self.dcLuminanceCodes = dcLuminanceCodes
         self.acLuminanceCodes = acLuminanceCodes
         self.dcChrominanceCodes = dcChrominanceCodes
-        self.acChrominanceCodes = acChrominanceCodes
\ No newline at end of file
+        self.acChrominanceCodes = acChrominanceCodes
+        self.lookups = None
+
+    def CalLookups(self):
+        # built once per table set, the shared default tables keep theirs for every image
+        if self.lookups is None:
+            dcLookup = BuildCodeLookup([self.dcLuminanceCodes, self.dcChrominanceCodes])
+            acLookup = BuildCodeLookup([self.acLuminanceCodes, self.acChrominanceCodes])
+            for array in dcLookup + acLookup:
+                array.setflags(write=False)
+            self.lookups = (dcLookup, acLookup)
+
+        return self.lookups
+
+# one shared instance, so writers can recognise the default tables and cache what they build from them
+DEFAULT_HUFFMAN_TABLE = HuffmanTable(DCLuminanceCodes, ACLuminanceCodes, DCChrominanceCodes, ACChrominanceCodes)
@@ -0,0 +1,127 @@
+import time
+import tracemalloc
+import numpy as np
+from contextlib import contextmanager, nullcontext
+from .huffman import COMPONENT_TABLES
+
+# shared by every disabled call site, entering it costs next to nothing
+DISABLED = nullcontext()
+
+class EncodeStats:
+    def __init__(self, traceMemory=True, onStage=None):
+        self.traceMemory = traceMemory
+        # called with the stage name, its seconds and its peak bytes as every stage ends
+        self.onStage = onStage
+
+        self.stageTimes = {}
+        self.peakAllocations = {}
+        self.peakAllocation = 0
+        self.blockCount = 0
+        self.statistics = None
+        self.dcBits = 0
+        self.acBits = 0
+        self.headerBytes = 0
+        self.scanBytes = 0
+        self.stuffingBytes = 0
+        self.markerBytes = 0
+        self.fileBytes = 0
+
+    @property
+    def headerBits(self):
+        # everything outside the entropy coded data: markers, tables, frame and scan headers
+        return 8 * self.headerBytes
+
+    @property
+    def paddingBits(self):
+        # bits that fill the scan up to whole bytes, at its end and before every restart marker
+        if self.statistics is None:
+            return None
+
+        return 8 * (self.scanBytes - self.stuffingBytes - self.markerBytes) - self.dcBits - self.acBits
+
+    def RecordStage(self, name, seconds, peakBytes):
+        self.stageTimes[name] = self.stageTimes.get(name, 0.0) + seconds
+        self.peakAllocations[name] = max(self.peakAllocations.get(name, 0), peakBytes)
+        self.peakAllocation = max(self.peakAllocation, peakBytes)
+
+        if self.onStage is not None:
+            self.onStage(name, seconds, peakBytes)
+
+    def RecordSymbols(self, statistics, tables, components=(0, 1, 2)):
+        # bits per symbol are its code length plus the amplitude bits its category asks for
+        dcLookup, acLookup = tables.CalLookups()
+        symbols = np.arange(256)
+        dcBits, acBits = 0, 0
+
+        for component in set(components):
+            tableId = COMPONENT_TABLES[component]
+            dcLengths = np.maximum(dcLookup[1][tableId], 0) + symbols
+            acLengths = np.maximum(acLookup[1][tableId], 0) + (symbols & 15)
+            dcBits += int(statistics.dcHistograms[component] @ dcLengths)
+            acBits += int(statistics.acHistograms[component] @ acLengths)
+
+        self.statistics = statistics
+        self.dcBits = dcBits
+        self.acBits = acBits
+
+    def AsDict(self) -> dict:
+        return {
+            "stageTimes": dict(self.stageTimes),
+            "peakAllocations": dict(self.peakAllocations),
+            "peakAllocation": self.peakAllocation,
+            "blockCount": self.blockCount,
+            "dcHistograms": None if self.statistics is None else self.statistics.dcHistograms.tolist(),
+            "acHistograms": None if self.statistics is None else self.statistics.acHistograms.tolist(),
+            "dcBits": self.dcBits,
+            "acBits": self.acBits,
+            "headerBits": self.headerBits,
+            "paddingBits": self.paddingBits,
+            "stuffingBytes": self.stuffingBytes,
+            "markerBytes": self.markerBytes,
+            "fileBytes": self.fileBytes,
+        }
+
+@contextmanager
+def MeasureStage(stats: EncodeStats, name):
+    tracing = stats.traceMemory and tracemalloc.is_tracing()
+    if tracing:
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        peakBytes = tracemalloc.get_traced_memory()[1] - baseline if tracing else 0
+        stats.RecordStage(name, seconds, peakBytes)
+
+def Stage(stats, name):
+    return DISABLED if stats is None else MeasureStage(stats, name)
+
+@contextmanager
+def MeasureEncode(stats: EncodeStats):
+    # numpy reports its buffers to tracemalloc, so the peaks cover the arrays of every stage
+    started = stats.traceMemory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+
+    tracing = stats.traceMemory and tracemalloc.is_tracing()
+    if tracing:
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        # the stages reset the peak as they start, so the whole encode is at least their largest peak
+        peakBytes = tracemalloc.get_traced_memory()[1] - baseline if tracing else 0
+        stats.RecordStage("Total", seconds, max(peakBytes, stats.peakAllocation))
+
+        if started:
+            tracemalloc.stop()
+
+def Recording(stats):
+    return DISABLED if stats is None else MeasureEncode(stats)
@@ -0,0 +1,139 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from . import filesaver, tools
+from .dctbackends import DEFAULT_DCT
+from .quantization import DEFAULT_QUALITY, QuantizationTables
+from .entropy import EncodeSegments, RestartMarker
+from .huffman import COMPONENT_TABLES, Huffman
+from .instrumentation import Stage
+from .statistics import CalSymbolStatistics, SymbolStatistics
+
+def CreateSharedArray(shape, dtype):
+    size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    shm = shared_memory.SharedMemory(create=True, size=size)
+
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def AttachSharedArray(name, shape, dtype):
+    shm = shared_memory.SharedMemory(name=name)
+
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def SplitRange(stop, step):
+    return [(start, min(start + step, stop)) for start in range(0, stop, step)]
+
+def TransformBand(imageName, imageShape, coefficientName, coefficientShape, rowStart, rowStop, subsampling = "4:4:4", quality = DEFAULT_QUALITY, dct = DEFAULT_DCT):
+    imageShm, image = AttachSharedArray(imageName, imageShape, np.uint8)
+    coefficientShm, coefficients = AttachSharedArray(coefficientName, coefficientShape, np.int32)
+
+    try:
+        mcuHeight, mcuWidth = tools.MCUSize(subsampling)
+        mcusPerRow = -(-imageShape[1] // mcuWidth)
+        ycbcrBand = tools.TransformToYCbCr(image[rowStart:rowStop])
+        # the last band may end inside an MCU row, its partial MCUs are edge replicated by SplitMCUs
+        coefficients[rowStart // mcuHeight * mcusPerRow:-(-rowStop // mcuHeight) * mcusPerRow] = tools.TransformBlocks(ycbcrBand, subsampling, quality, dct=dct)
+    finally:
+        # the views have to go before the shared memory can be closed
+        del image, coefficients
+        imageShm.close()
+        coefficientShm.close()
+
+def BandDCAC(coefficients, blockStart, blockStop, restartInterval, components = (0, 1, 2)):
+    band = coefficients[blockStart:blockStop]
+    dcMatrix = tools.CalDCDifferences(band[:, :, 0], restartInterval, components)
+    # always a copy, a band of a single grayscale block is contiguous already and would outlive the shared memory
+    acMatrix = np.array(band[:, :, 1:])
+
+    return dcMatrix, acMatrix
+
+def CountBand(coefficientName, coefficientShape, blockStart, blockStop, restartInterval, components = (0, 1, 2)):
+    coefficientShm, coefficients = AttachSharedArray(coefficientName, coefficientShape, np.int32)
+
+    try:
+        statistics = CalSymbolStatistics(*BandDCAC(coefficients, blockStart, blockStop, restartInterval, components), components)
+    finally:
+        del coefficients
+        coefficientShm.close()
+
+    return statistics.dcHistograms, statistics.acHistograms
+
+def EncodeBand(coefficientName, coefficientShape, blockStart, blockStop, restartInterval, components, dcLookup, acLookup):
+    coefficientShm, coefficients = AttachSharedArray(coefficientName, coefficientShape, np.int32)
+
+    try:
+        dcMatrix, acMatrix = BandDCAC(coefficients, blockStart, blockStop, restartInterval, components)
+    finally:
+        del coefficients
+        coefficientShm.close()
+
+    tableIds = np.tile(COMPONENT_TABLES[list(components)], dcMatrix.shape[0])
+
+    return EncodeSegments(dcMatrix.reshape(-1), acMatrix.reshape(-1, acMatrix.shape[-1]), tableIds, dcLookup, acLookup, restartInterval * dcMatrix.shape[1])
+
+def JoinSegments(results):
+    index = 0
+    for segments in results:
+        for segment in segments:
+            if index > 0:
+                yield RestartMarker.ForInterval(index - 1)
+            yield segment
+            index += 1
+
+def EncodeParallel(imgMatrix: np.ndarray, f, workers, optimize = False, restartInterval = 0, subsampling = "4:4:4", quality = DEFAULT_QUALITY, stats = None, dct = DEFAULT_DCT) -> int:
+    height, width, channels = imgMatrix.shape
+    mcuHeight, mcuWidth = tools.MCUSize(subsampling)
+    components = tools.MCUComponents(subsampling, channels)
+    rows, cols = -(-height // mcuHeight) * mcuHeight, -(-width // mcuWidth) * mcuWidth
+    mcusPerRow = cols // mcuWidth
+    mcuCount = rows // mcuHeight * mcusPerRow
+
+    # every band has to start a new entropy coded segment, so restarts default to one MCU row
+    restartInterval = restartInterval or mcusPerRow
+
+    imageShape = (height, width, channels)
+    coefficientShape = (mcuCount, len(components), 64)
+    imageShm, image = CreateSharedArray(imageShape, np.uint8)
+    coefficientShm, coefficients = CreateSharedArray(coefficientShape, np.int32)
+
+    try:
+        image[:] = imgMatrix
+
+        with ProcessPoolExecutor(workers) as pool:
+            # horizontal bands of whole MCU rows, a few per worker to even out the load
+            bandRows = -(-rows // mcuHeight // (2 * workers)) * mcuHeight
+            bands = SplitRange(height, bandRows)
+            with Stage(stats, "TransformBands"):
+                list(pool.map(TransformBand, *zip(*[(imageShm.name, imageShape, coefficientShm.name, coefficientShape, start, stop, subsampling, quality, dct) for start, stop in bands])))
+
+            intervalCount = -(-mcuCount // restartInterval)
+            groupMCUs = -(-intervalCount // (4 * workers)) * restartInterval
+            groups = [(coefficientShm.name, coefficientShape, start, stop, restartInterval, components) for start, stop in SplitRange(mcuCount, groupMCUs)]
+
+            statistics = None
+            if optimize or stats is not None:
+                with Stage(stats, "CalSymbolStatistics"):
+                    histograms = list(pool.map(CountBand, *zip(*groups)))
+                    statistics = SymbolStatistics(sum(dc for dc, _ in histograms), sum(ac for _, ac in histograms))
+            tables = Huffman(None, None, components).CalDCACCode(useDefault=not optimize, statistics=statistics)
+
+            if stats is not None:
+                stats.blockCount = mcuCount * len(components)
+                stats.RecordSymbols(statistics, tables, components)
+
+            # the bands are entropy coded in the pool while the segments are written in order
+            with Stage(stats, "WriteJpeg"):
+                lookups = tables.CalLookups()
+                results = pool.map(EncodeBand, *zip(*[group + lookups for group in groups]))
+
+                return filesaver.WriteJpegTo(f, JoinSegments(results), tables, *QuantizationTables(quality), height, width, restartInterval, subsampling, stats=stats, num_components=channels)
+    finally:
+        del image, coefficients
+        imageShm.close()
+        imageShm.unlink()
+        coefficientShm.close()
+        coefficientShm.unlink()
+
+def CompressionImgParallel(imgMatrix: np.ndarray, outputAddr, workers, optimize = False, restartInterval = 0, subsampling = "4:4:4", quality = DEFAULT_QUALITY, stats = None, dct = DEFAULT_DCT) -> int:
+    with filesaver.OutputFile(outputAddr) as f:
+        return EncodeParallel(imgMatrix, f, workers, optimize, restartInterval, subsampling, quality, stats, dct)
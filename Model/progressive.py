@@ -0,0 +1,351 @@
+import numpy as np
+from .entropy import BitPacker, BuildCodeLookup, CalAmplitude, CalCategory, CalLastIndex, LookupCodes
+from .huffman import COMPONENT_TABLES, build_optimal_codes
+
+# a scan sends coefficients start to end of its components in zig-zag order, point transformed by low bits;
+# high is the low of the previous scan of the same band, 0 for the first one
+class Scan:
+    def __init__(self, components, start, end, high=0, low=0):
+        self.components = tuple(components)
+        self.start = start
+        self.end = end
+        self.high = high
+        self.low = low
+
+    def __repr__(self):
+        return f"Scan({self.components}, {self.start}, {self.end}, {self.high}, {self.low})"
+
+SCAN_SCRIPTS = {
+    # DC of every component first, then the low frequencies of each, then the high ones
+    "spectral": (
+        Scan((0, 1, 2), 0, 0),
+        Scan((0,), 1, 5),
+        Scan((1,), 1, 5),
+        Scan((2,), 1, 5),
+        Scan((0,), 6, 63),
+        Scan((1,), 6, 63),
+        Scan((2,), 6, 63),
+    ),
+    # libjpeg's jpeg_simple_progression: the top bits first, then one refinement scan per dropped bit
+    "successive": (
+        Scan((0, 1, 2), 0, 0, 0, 1),
+        Scan((0,), 1, 5, 0, 2),
+        Scan((2,), 1, 63, 0, 1),
+        Scan((1,), 1, 63, 0, 1),
+        Scan((0,), 6, 63, 0, 2),
+        Scan((0,), 1, 63, 2, 1),
+        Scan((0, 1, 2), 0, 0, 1, 0),
+        Scan((2,), 1, 63, 1, 0),
+        Scan((1,), 1, 63, 1, 0),
+        Scan((0,), 1, 63, 1, 0),
+    ),
+}
+
+# longest end of block run a single EOBn symbol can carry
+MAX_EOB_RUN = 0x7FFF
+FIELDS_PER_PACK = 1 << 18
+
+class EncodedScan:
+    def __init__(self, scan: Scan, tableIds, huffmanTables, chunks):
+        self.scan = scan
+        # the table of every scan component, and the (class, destination, codes) DHT tables sent before the scan
+        self.tableIds = tableIds
+        self.huffmanTables = huffmanTables
+        self.chunks = chunks
+
+def ScanScript(progressive, numComponents = 3) -> tuple:
+    # True picks the spectral script, a name one of SCAN_SCRIPTS, anything else is taken as a list of scans
+    if progressive is True:
+        progressive = "spectral"
+    if isinstance(progressive, str):
+        if progressive not in SCAN_SCRIPTS:
+            raise ValueError(f"progressive should be one of {', '.join(SCAN_SCRIPTS)} or a list of scans")
+        scans = SCAN_SCRIPTS[progressive]
+    else:
+        scans = tuple(scan if isinstance(scan, Scan) else Scan(*scan) for scan in progressive)
+
+    # a script written for three components keeps the luminance scans of a single component image
+    if numComponents == 1:
+        scans = tuple(Scan((0,), scan.start, scan.end, scan.high, scan.low) for scan in scans if 0 in scan.components)
+
+    CheckScanScript(scans, numComponents)
+
+    return scans
+
+def CheckScanScript(scans, numComponents = 3):
+    if not scans:
+        raise ValueError("A progressive scan script needs at least one scan")
+
+    # the bit every coefficient of every component was sent down to, -1 before its first scan
+    sentTo = np.full((numComponents, 64), -1)
+    for scan in scans:
+        if not scan.components or any(not 0 <= component < numComponents for component in scan.components):
+            raise ValueError(f"{scan} refers to a component the image does not have")
+        if not 0 <= scan.start <= scan.end <= 63 or (scan.start == 0 and scan.end != 0):
+            raise ValueError(f"{scan} should send the DC alone or an AC band within 1 to 63")
+        if scan.start > 0 and len(scan.components) != 1:
+            raise ValueError(f"{scan} is an AC scan and may only hold one component")
+        if not 0 <= scan.low <= 13 or (scan.high != 0 and scan.high != scan.low + 1):
+            raise ValueError(f"{scan} should refine exactly one bit below the previous scan")
+
+        for component in scan.components:
+            band = sentTo[component, scan.start:scan.end + 1]
+            expected = -1 if scan.high == 0 else scan.high
+            if (band != expected).any():
+                raise ValueError(f"{scan} does not follow the previous scans of component {component}")
+            band[:] = scan.low
+
+    if (sentTo != 0).any():
+        raise ValueError("The scan script should send every coefficient of every component down to bit 0")
+
+def CeilDiv(a, b):
+    return -(-a // b)
+
+def ComponentBlocks(zigzagBlocks: np.ndarray, components, component, lumaSampling, imageHeight, imageWidth) -> np.ndarray:
+    # the blocks of one component in raster order over its own grid, which drops the MCU padding blocks
+    h, v = lumaSampling
+    hc, vc = (h, v) if component == 0 else (1, 1)
+    mcuRows, mcuCols = CeilDiv(imageHeight, 8 * v), CeilDiv(imageWidth, 8 * h)
+    blockRows = CeilDiv(CeilDiv(imageHeight * vc, v), 8)
+    blockCols = CeilDiv(CeilDiv(imageWidth * hc, h), 8)
+
+    slots = [slot for slot, slotComponent in enumerate(components) if slotComponent == component]
+    grid = zigzagBlocks[:, slots].reshape(mcuRows, mcuCols, vc, hc, 64).transpose(0, 2, 1, 3, 4)
+
+    return grid.reshape(mcuRows * vc, mcuCols * hc, 64)[:blockRows, :blockCols].reshape(-1, 64)
+
+def DCDifferences(values: np.ndarray, slotComponents) -> np.ndarray:
+    # every component keeps its own predictor through the scan, starting from 0
+    differences = np.empty_like(values)
+    for component in set(slotComponents):
+        slots = [slot for slot, slotComponent in enumerate(slotComponents) if slotComponent == component]
+        sequence = values[:, slots].reshape(-1)
+        differences[:, slots] = np.diff(sequence, prepend=0).reshape(-1, len(slots))
+
+    return differences
+
+def OptimalTable(histogram: np.ndarray):
+    codes = build_optimal_codes({int(symbol): int(histogram[symbol]) for symbol in np.nonzero(histogram)[0]})
+
+    return codes, BuildCodeLookup([codes])
+
+def EncodeDCFirst(differences: np.ndarray, tableIds: np.ndarray) -> tuple:
+    # the differences of the point transformed DC values and their tables, in scan order
+    sizes = CalCategory(differences)
+
+    huffmanTables, codeValues, codeLengths = [], np.zeros(sizes.size, dtype=np.uint64), np.zeros(sizes.size, dtype=np.int64)
+    for tableId in np.unique(tableIds):
+        used = tableIds == tableId
+        codes, lookup = OptimalTable(np.bincount(sizes[used], minlength=256))
+        codeValues[used], codeLengths[used] = LookupCodes(lookup, np.zeros(used.sum(), dtype=np.int64), sizes[used])
+        huffmanTables.append((0, int(tableId), codes))
+
+    values = (codeValues << sizes.astype(np.uint64)) | CalAmplitude(differences, sizes)
+
+    return huffmanTables, values, codeLengths + sizes
+
+def EncodeDCRefine(dcValues: np.ndarray, low) -> tuple:
+    # one raw bit per block, the bit low of its DC
+    return [], ((dcValues >> low) & 1).astype(np.uint64), np.ones(dcValues.size, dtype=np.int64)
+
+def EncodeACFirst(band: np.ndarray, low, tableId) -> tuple:
+    blockCount, bandLength = band.shape
+    values = np.sign(band) * (np.abs(band) >> low)
+
+    rows, cols = np.nonzero(values)
+    nonZero = values[rows, cols]
+    previous = np.empty_like(cols)
+    previous[0:1] = -1
+    previous[1:] = np.where(rows[1:] == rows[:-1], cols[:-1], -1)
+    runLength = cols - previous - 1
+    sizes = CalCategory(nonZero)
+    runSizePairs = ((runLength & 15) << 4) | sizes
+    zrlCount = runLength >> 4
+
+    # a block whose band ends in zeros joins the end of block run, which is sent when the next block with a
+    # coefficient starts and at the end of the scan, MAX_EOB_RUN blocks at most per symbol
+    counts = np.bincount(rows, minlength=blockCount)
+    lastCol = np.full(blockCount, -1)
+    lastCol[rows] = cols
+    hasEOB = lastCol < bandLength - 1
+    segmentStarts = (counts > 0)
+    segmentStarts[0] = True
+    segmentIds = np.cumsum(segmentStarts) - 1
+    segmentRuns = np.bincount(segmentIds, weights=hasEOB).astype(np.int64)
+    segmentPieces = -(-segmentRuns // MAX_EOB_RUN)
+    segmentEnds = np.append(np.nonzero(segmentStarts)[0][1:], blockCount) - 1
+
+    eobFields = np.zeros(blockCount, dtype=np.int64)
+    eobFields[segmentEnds] = segmentPieces
+    pieceSegments = np.repeat(np.arange(segmentRuns.size), segmentPieces)
+    pieceRank = np.arange(pieceSegments.size) - np.repeat(np.cumsum(segmentPieces) - segmentPieces, segmentPieces)
+    pieceRuns = np.minimum(segmentRuns[pieceSegments] - pieceRank * MAX_EOB_RUN, MAX_EOB_RUN)
+    eobBits = CalCategory(pieceRuns) - 1
+
+    histogram = np.bincount(runSizePairs, minlength=256) + np.bincount(eobBits << 4, minlength=256)
+    histogram[0xF0] += zrlCount.sum()
+    codes, lookup = OptimalTable(histogram)
+
+    # three ZRL fields and a code field per coefficient, then the EOB runs sent after the block
+    fieldCounts = 4 * counts + eobFields
+    blockStart = np.cumsum(fieldCounts) - fieldCounts
+    fieldValues = np.zeros(fieldCounts.sum(), dtype=np.uint64)
+    fieldLengths = np.zeros(fieldCounts.sum(), dtype=np.int64)
+
+    rank = np.arange(rows.size) - (np.cumsum(counts) - counts)[rows]
+    slot = blockStart[rows] + 4 * rank
+    if zrlCount.any():
+        zrlCode, zrlLength = LookupCodes(lookup, np.zeros(1, dtype=np.int64), np.array([0xF0]))
+        for i in range(int(zrlCount.max())):
+            used = zrlCount > i
+            fieldValues[slot[used] + i] = zrlCode[0]
+            fieldLengths[slot[used] + i] = zrlLength[0]
+
+    tableIds = np.zeros(rows.size, dtype=np.int64)
+    acCodes, acLengths = LookupCodes(lookup, tableIds, runSizePairs)
+    fieldValues[slot + 3] = (acCodes << sizes.astype(np.uint64)) | CalAmplitude(nonZero, sizes)
+    fieldLengths[slot + 3] = acLengths + sizes
+
+    pieceBlocks = segmentEnds[pieceSegments]
+    pieceSlot = blockStart[pieceBlocks] + 4 * counts[pieceBlocks] + pieceRank
+    eobCodes, eobLengths = LookupCodes(lookup, np.zeros(pieceRuns.size, dtype=np.int64), eobBits << 4)
+    extra = (pieceRuns - (np.int64(1) << eobBits)).astype(np.uint64)
+    fieldValues[pieceSlot] = (eobCodes << eobBits.astype(np.uint64)) | extra
+    fieldLengths[pieceSlot] = eobLengths + eobBits
+
+    return [(1, tableId, codes)], fieldValues, fieldLengths
+
+def EncodeACRefine(band: np.ndarray, low, tableId) -> tuple:
+    # symbols are -1 for raw bits, which are sent as they are; everything else is coded once the table is known
+    symbols, extraValues, extraLengths = [], [], []
+
+    def EmitSymbol(symbol, value=0, length=0):
+        symbols.append(symbol)
+        extraValues.append(value)
+        extraLengths.append(length)
+
+    def EmitBits(bits):
+        for bit in bits:
+            EmitSymbol(-1, bit, 1)
+
+    eobRun, eobBits = 0, []
+
+    def EmitEOBRun():
+        nonlocal eobRun, eobBits
+        if eobRun > 0:
+            bits = eobRun.bit_length() - 1
+            EmitSymbol(bits << 4, eobRun - (1 << bits), bits)
+            EmitBits(eobBits)
+            eobRun, eobBits = 0, []
+
+    def AddEmptyBlocks(count):
+        # a block with nothing sent so far only lengthens the end of block run
+        nonlocal eobRun
+        while count > 0:
+            step = min(count, MAX_EOB_RUN - eobRun)
+            eobRun += step
+            count -= step
+            if eobRun == MAX_EOB_RUN:
+                EmitEOBRun()
+
+    bandLength = band.shape[1]
+    absolute = np.abs(band) >> low
+    # the last coefficient that becomes non-zero in this scan, -1 when there is none
+    lastNew = CalLastIndex(absolute == 1)
+    rows, cols = np.nonzero(absolute)
+    rowStarts = np.searchsorted(rows, np.arange(band.shape[0] + 1))
+    colList, valueList, signList = cols.tolist(), absolute[rows, cols].tolist(), (band[rows, cols] > 0).tolist()
+
+    previousBlock = -1
+    for block in np.unique(rows).tolist():
+        AddEmptyBlocks(block - previousBlock - 1)
+        previousBlock = block
+        start, stop = int(rowStarts[block]), int(rowStarts[block + 1])
+        run, previous, corrections = 0, -1, []
+        last = int(lastNew[block])
+        for i in range(start, stop):
+            col, value = colList[i], valueList[i]
+            run += col - previous - 1
+            previous = col
+            # zero runs past the last new coefficient fold into the end of block instead
+            while run > 15 and col <= last:
+                EmitEOBRun()
+                EmitSymbol(0xF0)
+                run -= 16
+                EmitBits(corrections)
+                corrections = []
+            if value > 1:
+                # already sent by an earlier scan, only its next bit goes out
+                corrections.append(value & 1)
+                continue
+
+            EmitEOBRun()
+            EmitSymbol((run << 4) | 1, int(signList[i]), 1)
+            EmitBits(corrections)
+            corrections = []
+            run = 0
+
+        run += bandLength - 1 - previous
+        if run > 0 or corrections:
+            eobRun += 1
+            eobBits += corrections
+            if eobRun == MAX_EOB_RUN:
+                EmitEOBRun()
+
+    AddEmptyBlocks(band.shape[0] - 1 - previousBlock)
+    EmitEOBRun()
+
+    symbols = np.array(symbols, dtype=np.int64)
+    extraValues = np.array(extraValues, dtype=np.uint64)
+    extraLengths = np.array(extraLengths, dtype=np.int64)
+    coded = symbols >= 0
+    codes, lookup = OptimalTable(np.bincount(symbols[coded], minlength=256))
+
+    fieldValues, fieldLengths = extraValues.copy(), extraLengths.copy()
+    codeValues, codeLengths = LookupCodes(lookup, np.zeros(coded.sum(), dtype=np.int64), symbols[coded])
+    fieldValues[coded] = (codeValues << extraLengths[coded].astype(np.uint64)) | extraValues[coded]
+    fieldLengths[coded] = codeLengths + extraLengths[coded]
+
+    return [(1, tableId, codes)], fieldValues, fieldLengths
+
+def PackScan(values: np.ndarray, lengths: np.ndarray):
+    # every scan is padded with 1 bits to a whole byte on its own
+    packer = BitPacker()
+    for start in range(0, values.size, FIELDS_PER_PACK):
+        yield packer.Pack(values[start:start + FIELDS_PER_PACK], lengths[start:start + FIELDS_PER_PACK])
+    yield packer.Flush()
+
+def EncodeScan(zigzagBlocks: np.ndarray, components, lumaSampling, imageHeight, imageWidth, scan: Scan) -> EncodedScan:
+    tableIds = [int(COMPONENT_TABLES[component]) for component in scan.components]
+
+    if scan.start == 0:
+        if len(scan.components) == 1:
+            dcValues = ComponentBlocks(zigzagBlocks, components, scan.components[0], lumaSampling, imageHeight, imageWidth)[:, 0]
+            slotTables = np.full(dcValues.size, tableIds[0])
+            if scan.high == 0:
+                dcValues = np.diff(dcValues >> scan.low, prepend=0)
+        else:
+            # interleaved, MCU by MCU over the slots of the scan components
+            slots = [slot for slot, component in enumerate(components) if component in scan.components]
+            slotComponents = [components[slot] for slot in slots]
+            dcValues = zigzagBlocks[:, slots, 0]
+            if scan.high == 0:
+                dcValues = DCDifferences(dcValues >> scan.low, slotComponents)
+            slotTables = np.tile(COMPONENT_TABLES[slotComponents], dcValues.shape[0])
+            dcValues = dcValues.reshape(-1)
+
+        if scan.high == 0:
+            huffmanTables, values, lengths = EncodeDCFirst(dcValues, slotTables)
+        else:
+            huffmanTables, values, lengths = EncodeDCRefine(dcValues, scan.low)
+    else:
+        band = ComponentBlocks(zigzagBlocks, components, scan.components[0], lumaSampling, imageHeight, imageWidth)[:, scan.start:scan.end + 1]
+        encode = EncodeACFirst if scan.high == 0 else EncodeACRefine
+        huffmanTables, values, lengths = encode(band, scan.low, tableIds[0])
+
+    return EncodedScan(scan, tableIds, huffmanTables, PackScan(values, lengths))
+
+def EncodeProgressive(zigzagBlocks: np.ndarray, components, lumaSampling, imageHeight, imageWidth, scans):
+    # zigzagBlocks holds the quantized (MCU, slot, 64) coefficients of the baseline path, every one is coded
+    for scan in scans:
+        yield EncodeScan(zigzagBlocks, components, lumaSampling, imageHeight, imageWidth, scan)
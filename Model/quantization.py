@@ -0,0 +1,73 @@
+import numpy as np
+from functools import lru_cache
+
+# tables of the JPEG standard, Annex K.1
+STANDARD_LUMINANCE_QUANTIZATION_TABLE = np.array([
+    [16, 11, 10, 16, 24, 40, 51, 61],
+    [12, 12, 14, 19, 26, 58, 60, 55],
+    [14, 13, 16, 24, 40, 57, 69, 56],
+    [14, 17, 22, 29, 51, 87, 80, 62],
+    [18, 22, 37, 56, 68, 109, 103, 77],
+    [24, 35, 55, 64, 81, 104, 113, 92],
+    [49, 64, 78, 87, 103, 121, 120, 101],
+    [72, 92, 95, 98, 112, 100, 103, 99]
+])
+
+STANDARD_CHROMINANCE_QUANTIZATION_TABLE = np.array([
+    [17, 18, 24, 47, 99, 99, 99, 99],
+    [18, 21, 26, 66, 99, 99, 99, 99],
+    [24, 26, 56, 99, 99, 99, 99, 99],
+    [47, 66, 99, 99, 99, 99, 99, 99],
+    [99, 99, 99, 99, 99, 99, 99, 99],
+    [99, 99, 99, 99, 99, 99, 99, 99],
+    [99, 99, 99, 99, 99, 99, 99, 99],
+    [99, 99, 99, 99, 99, 99, 99, 99]
+])
+
+# the encoder's original fixed tables are the standard ones at quality 90
+DEFAULT_QUALITY = 90
+CACHED_QUALITIES = 8
+
+ZIGZAG_ORDER = np.array([
+     0,  1,  8, 16,  9,  2,  3, 10,
+    17, 24, 32, 25, 18, 11,  4,  5,
+    12, 19, 26, 33, 40, 48, 41, 34,
+    27, 20, 13,  6,  7, 14, 21, 28,
+    35, 42, 49, 56, 57, 50, 43, 36,
+    29, 22, 15, 23, 30, 37, 44, 51,
+    58, 59, 52, 45, 38, 31, 39, 46,
+    53, 60, 61, 54, 47, 55, 62, 63
+])
+
+def CheckQuality(quality):
+    if not 1 <= quality <= 100:
+        raise ValueError("quality should be between 1 and 100")
+
+def ScaleQuantizationTable(table: np.ndarray, quality) -> np.ndarray:
+    # IJG scaling: 50 keeps the standard table, lower qualities grow it and higher ones shrink it
+    CheckQuality(quality)
+    scale = 5000 // quality if quality < 50 else 200 - 2 * int(quality)
+
+    return np.clip((table * scale + 50) // 100, 1, 255)
+
+def DQTPayload(table: np.ndarray) -> bytes:
+    return table.reshape(-1)[ZIGZAG_ORDER].astype(np.uint8).tobytes()
+
+class QuantizationTable:
+    def __init__(self, table: np.ndarray, quality = None):
+        self.table = table
+        self.quality = quality
+        # quantizing multiplies by the reciprocal instead of dividing by the table
+        self.reciprocal = 1.0 / table
+        self.payload = DQTPayload(table)
+
+        # shared by every caller through the cache, so nobody may change them
+        self.table.setflags(write=False)
+        self.reciprocal.setflags(write=False)
+
+@lru_cache(maxsize=CACHED_QUALITIES)
+def QuantizationTables(quality = DEFAULT_QUALITY) -> tuple:
+    luminance = QuantizationTable(ScaleQuantizationTable(STANDARD_LUMINANCE_QUANTIZATION_TABLE, quality), quality)
+    chrominance = QuantizationTable(ScaleQuantizationTable(STANDARD_CHROMINANCE_QUANTIZATION_TABLE, quality), quality)
+
+    return luminance, chrominance
@@ -0,0 +1,322 @@
+import argparse
+import asyncio
+import io
+import json
+import multiprocessing
+import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+from PIL import Image
+from . import dctbackends, filesaver, tools
+from .progressive import SCAN_SCRIPTS
+
+# images up to this many pixels take the priority lane
+SMALL_IMAGE_PIXELS = 256 * 256
+MAX_BODY_BYTES = 64 << 20
+MAX_HEADER_BYTES = 16 << 10
+RESPONSE_CHUNK_BYTES = 64 << 10
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    411: "Length Required",
+    413: "Payload Too Large",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+}
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def ParseOptions(query) -> dict:
+    params = {key: values[-1] for key, values in parse_qs(query).items()}
+    options = {}
+
+    try:
+        if "quality" in params:
+            options["quality"] = int(params.pop("quality"))
+        if "restartInterval" in params:
+            options["restartInterval"] = int(params.pop("restartInterval"))
+    except ValueError:
+        raise HttpError(400, "quality and restartInterval should be integers")
+    if "optimize" in params:
+        options["optimize"] = params.pop("optimize").lower() in ("1", "true", "yes")
+    if "subsampling" in params:
+        options["subsampling"] = params.pop("subsampling")
+        if options["subsampling"] not in filesaver.SAMPLING_FACTORS:
+            raise HttpError(400, f"subsampling should be one of {', '.join(filesaver.SAMPLING_FACTORS)}")
+    if "progressive" in params:
+        progressive = params.pop("progressive").lower()
+        if progressive in ("1", "true", "yes", "0", "false", "no"):
+            options["progressive"] = progressive in ("1", "true", "yes")
+        elif progressive in SCAN_SCRIPTS:
+            options["progressive"] = progressive
+        else:
+            raise HttpError(400, f"progressive should be a boolean or one of {', '.join(SCAN_SCRIPTS)}")
+    if "dct" in params:
+        options["dct"] = params.pop("dct")
+        if options["dct"] not in tools.DCT_ENGINES:
+            raise HttpError(400, f"dct should be one of {', '.join(tools.DCT_ENGINES)}")
+    if params:
+        raise HttpError(400, f"Unknown options: {', '.join(sorted(params))}")
+
+    return options
+
+def EncodeBytes(data, options) -> bytes:
+    # runs in a pool process, the event loop only ever sees bytes
+    return tools.encode(Image.open(io.BytesIO(data)), **options)
+
+class Lanes:
+    # queued jobs wait here until a pool slot takes them, small images first; each lane has its own bound
+    # so a flood of large uploads cannot push small ones out
+    def __init__(self, maxQueue):
+        self.maxQueue = maxQueue
+        self.small = deque()
+        self.large = deque()
+        self.condition = asyncio.Condition()
+
+    def __len__(self):
+        return len(self.small) + len(self.large)
+
+    async def Put(self, job, isSmall) -> bool:
+        async with self.condition:
+            lane = self.small if isSmall else self.large
+            if len(lane) >= self.maxQueue:
+                return False
+            lane.append(job)
+            self.condition.notify_all()
+
+        return True
+
+    async def Take(self, smallOnly=False):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.small or (self.large and not smallOnly))
+
+            return self.small.popleft() if self.small else self.large.popleft()
+
+class EncodeServer:
+    def __init__(self, workers=os.cpu_count(), maxQueue=64, smallPixels=SMALL_IMAGE_PIXELS, maxBody=MAX_BODY_BYTES):
+        self.workers = max(1, workers)
+        self.maxQueue = maxQueue
+        self.smallPixels = smallPixels
+        self.maxBody = maxBody
+        self.pool = None
+        self.lanes = None
+        self.dispatchers = []
+        self.server = None
+        self.autoBackend = None
+        self.counters = {"encoded": 0, "rejected": 0, "failed": 0}
+
+    async def Start(self, host="127.0.0.1", port=8080, unixPath=None):
+        # pool processes start on the first request; forked from here they would inherit the open client sockets
+        # and hold every closed connection open, so they come from a forkserver where there is one
+        context = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else None)
+        self.pool = ProcessPoolExecutor(self.workers, mp_context=context)
+        self.lanes = Lanes(self.maxQueue)
+        # one pool slot per dispatcher, with more than one worker the first slot only serves small images
+        self.dispatchers = [asyncio.create_task(self.Dispatch(smallOnly=self.workers > 1 and slot == 0)) for slot in range(self.workers)]
+
+        if unixPath is not None:
+            self.server = await asyncio.start_unix_server(self.HandleConnection, unixPath, limit=MAX_HEADER_BYTES)
+        else:
+            self.server = await asyncio.start_server(self.HandleConnection, host, port, limit=MAX_HEADER_BYTES)
+
+        return self.server
+
+    async def Close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for dispatcher in self.dispatchers:
+            dispatcher.cancel()
+        await asyncio.gather(*self.dispatchers, return_exceptions=True)
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+
+    async def Dispatch(self, smallOnly):
+        loop = asyncio.get_running_loop()
+        while True:
+            data, options, future = await self.lanes.Take(smallOnly)
+            if future.cancelled():
+                continue
+
+            try:
+                result = await loop.run_in_executor(self.pool, EncodeBytes, data, options)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+
+    async def ResolveDCT(self, options):
+        # auto is measured once, by the first request that asks for it, on a thread so the event loop keeps serving;
+        # requests arriving meanwhile wait for the same measurement and the pool processes get the choice
+        if options.get("dct") == "auto":
+            if self.autoBackend is None:
+                self.autoBackend = asyncio.get_running_loop().run_in_executor(None, dctbackends.AutoBackend)
+            options["dct"] = await self.autoBackend
+
+    async def Encode(self, data, options) -> bytes:
+        try:
+            # only the header is parsed here, to pick a lane
+            with Image.open(io.BytesIO(data)) as image:
+                width, height = image.size
+        except Exception:
+            raise HttpError(400, "Body is not a readable image")
+
+        future = asyncio.get_running_loop().create_future()
+        if not await self.lanes.Put((data, options, future), width * height <= self.smallPixels):
+            self.counters["rejected"] += 1
+            raise HttpError(429, f"Queue is full ({self.maxQueue} images waiting in the {'small' if width * height <= self.smallPixels else 'large'} lane)")
+
+        try:
+            result = await future
+        except (ValueError, OSError) as e:
+            # bad options or an image PIL cannot decode
+            self.counters["failed"] += 1
+            raise HttpError(400, str(e))
+        except Exception as e:
+            self.counters["failed"] += 1
+            raise HttpError(500, f"Encoding failed: {e}")
+
+        self.counters["encoded"] += 1
+
+        return result
+
+    def Health(self) -> bytes:
+        return json.dumps({
+            "workers": self.workers,
+            "queued": {"small": len(self.lanes.small), "large": len(self.lanes.large)},
+            "maxQueue": self.maxQueue,
+            **self.counters,
+        }).encode()
+
+    async def HandleConnection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            keepAlive = True
+            while keepAlive:
+                keepAlive = await self.HandleRequest(reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def HandleRequest(self, reader, writer) -> bool:
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise
+            return False
+        except asyncio.LimitOverrunError:
+            await self.Respond(writer, 400, b"Request header too large", close=True)
+            return False
+
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ")
+        except ValueError:
+            await self.Respond(writer, 400, b"Malformed request line", close=True)
+            return False
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+
+        close = headers.get("connection", "").lower() == "close" or version == "HTTP/1.0"
+        url = urlsplit(target)
+        # a body left unread would be parsed as the next request, so any response sent before it is read ends the connection
+        unread = headers.get("content-length", "0") != "0" or "transfer-encoding" in headers
+
+        try:
+            if url.path == "/health" and method == "GET":
+                close = close or unread
+                await self.Respond(writer, 200, self.Health(), "application/json", close)
+            elif url.path != "/encode":
+                raise HttpError(404, f"No such path: {url.path}")
+            elif method != "POST":
+                raise HttpError(405, "Use POST /encode")
+            else:
+                options = ParseOptions(url.query)
+                data = await self.ReadBody(reader, headers)
+                unread = False
+                await self.ResolveDCT(options)
+                await self.Respond(writer, 200, await self.Encode(data, options), "image/jpeg", close)
+        except HttpError as e:
+            # without a Content-Length the end of the body is unknown, so those connections end here too
+            close = close or unread or e.status == 411
+            headers = {"Retry-After": "1"} if e.status == 429 else {}
+            await self.Respond(writer, e.status, str(e).encode(), close=close, extraHeaders=headers)
+
+        return not close
+
+    async def ReadBody(self, reader, headers) -> bytes:
+        if "content-length" not in headers:
+            raise HttpError(411, "Content-Length is required")
+        length = headers["content-length"]
+        if not (length.isascii() and length.isdigit()):
+            raise HttpError(400, f"Content-Length should be a non-negative integer: {length}")
+        length = int(length)
+        if length > self.maxBody:
+            raise HttpError(413, f"Body is larger than {self.maxBody} bytes")
+
+        return await reader.readexactly(length)
+
+    async def Respond(self, writer, status, body, contentType="text/plain", close=False, extraHeaders=None):
+        headers = {
+            "Content-Type": contentType,
+            "Content-Length": str(len(body)),
+            "Connection": "close" if close else "keep-alive",
+            **(extraHeaders or {}),
+        }
+        head = f"HTTP/1.1 {status} {REASONS[status]}\r\n" + "".join(f"{name}: {value}\r\n" for name, value in headers.items()) + "\r\n"
+        writer.write(head.encode("latin-1"))
+
+        # large results go out a slice at a time, waiting for the client to keep up
+        view = memoryview(body)
+        for start in range(0, len(view), RESPONSE_CHUNK_BYTES):
+            writer.write(view[start:start + RESPONSE_CHUNK_BYTES])
+            await writer.drain()
+        await writer.drain()
+
+async def Serve(args):
+    server = EncodeServer(args.workers, args.max_queue, args.small_pixels, args.max_body)
+    await server.Start(args.host, args.port, args.unix)
+
+    where = args.unix or f"http://{args.host}:{args.port}"
+    print(f"encoding on {where} with {server.workers} workers, POST /encode?quality=75 with the image as body")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.Close()
+
+def ParseArgs(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m Model.server", description="Serve JPEG encoding over local HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--unix", help="listen on this Unix socket instead of TCP")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(), help="encoder processes (default: all cpus)")
+    parser.add_argument("--max-queue", type=int, default=64, help="images waiting in each lane before 429 is returned")
+    parser.add_argument("--small-pixels", type=int, default=SMALL_IMAGE_PIXELS, help="images up to this many pixels take the priority lane")
+    parser.add_argument("--max-body", type=int, default=MAX_BODY_BYTES, help="largest accepted upload in bytes")
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    try:
+        asyncio.run(Serve(ParseArgs(argv)))
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,46 @@
+import numpy as np
+from .entropy import CalACSymbols, CalCategory, UNITS_PER_CHUNK
+
+def CalDCHistogram(dcValues: np.ndarray) -> np.ndarray:
+    return np.bincount(CalCategory(dcValues), minlength=256)
+
+def CalACHistogram(acValues: np.ndarray) -> np.ndarray:
+    histogram = np.zeros(256, dtype=np.int64)
+
+    for start in range(0, acValues.shape[0], UNITS_PER_CHUNK):
+        _, _, _, runSizePairs, zrlCount, hasEOB = CalACSymbols(acValues[start:start + UNITS_PER_CHUNK])
+
+        histogram += np.bincount(runSizePairs, minlength=256)
+        histogram[0xF0] += zrlCount.sum()
+        histogram[0x00] += hasEOB.sum()
+
+    return histogram
+
+class SymbolStatistics:
+    def __init__(self, dcHistograms: np.ndarray, acHistograms: np.ndarray):
+        self.dcHistograms = dcHistograms
+        self.acHistograms = acHistograms
+        self.dcSymbolCount = dcHistograms.sum(axis=1)
+        self.acSymbolCount = acHistograms.sum(axis=1)
+        self.symbolCount = int(self.dcSymbolCount.sum() + self.acSymbolCount.sum())
+
+    def Histogram(self, components, isDC=True) -> np.ndarray:
+        histograms = self.dcHistograms if isDC else self.acHistograms
+
+        return histograms[list(components)].sum(axis=0)
+
+    def Frequencies(self, components, isDC=True) -> dict:
+        histogram = self.Histogram(components, isDC)
+
+        return {int(symbol): int(histogram[symbol]) for symbol in np.nonzero(histogram)[0]}
+
+def CalSymbolStatistics(dcMatrix: np.ndarray, acMatrix: np.ndarray, components=(0, 1, 2)) -> SymbolStatistics:
+    # one histogram per component, summed over every block column that belongs to it
+    dcHistograms = np.zeros((max(components) + 1, 256), dtype=np.int64)
+    acHistograms = np.zeros((max(components) + 1, 256), dtype=np.int64)
+
+    for slot, component in enumerate(components):
+        dcHistograms[component] += CalDCHistogram(dcMatrix[:, slot])
+        acHistograms[component] += CalACHistogram(acMatrix[:, slot, :])
+
+    return SymbolStatistics(dcHistograms, acHistograms)
@@ -0,0 +1,197 @@
+import os
+import numpy as np
+from PIL import Image
+from . import bmpreader, filesaver, tools
+from .entropy import BitPacker, EncodeScanChunks, EncodeSegments, PadScan, RestartMarker
+from .huffman import COMPONENT_TABLES, Huffman
+from .instrumentation import Stage
+from .dctbackends import DEFAULT_DCT
+from .quantization import DEFAULT_QUALITY, QuantizationTables
+from .statistics import CalSymbolStatistics, SymbolStatistics
+
+# raw layouts that can be read row by row straight from the file: bytes per pixel and where R, G and B sit,
+# or the gray level of a grayscale image
+RAW_MODES = {
+    "L": (1, [0]),
+    "RGB": (3, [0, 1, 2]),
+    "BGR": (3, [2, 1, 0]),
+    "RGBX": (4, [0, 1, 2]),
+    "BGRX": (4, [2, 1, 0]),
+}
+
+class RowReader:
+    def __init__(self, imgAddr):
+        self.imgAddr = imgAddr
+        # BMPs are read through a memory map, other raw layouts row by row from the file
+        self.imgMatrix = bmpreader.TryReadBmp(imgAddr)
+        self.tiles = None
+
+        if self.imgMatrix is None:
+            img = Image.open(imgAddr)
+            self.tiles = self.__RawTiles(img)
+            self.imgMatrix = None if self.tiles else tools.ToImageArray(img)
+            self.channels = 1 if img.mode == "L" else 3
+            img.close()
+
+        if self.imgMatrix is not None:
+            # grayscale images are read as one channel and encoded as a single component
+            if self.imgMatrix.ndim == 2:
+                self.imgMatrix = self.imgMatrix[:, :, None]
+            self.height, self.width, self.channels = self.imgMatrix.shape
+
+    def __RawTiles(self, img):
+        # only uncompressed layouts that span the full width are streamed, anything else is decoded once by PIL
+        self.width, self.height = img.size
+        if img.mode not in ("RGB", "L"):
+            return None
+
+        tiles = []
+        for tile in img.tile:
+            codec, extents, offset, args = tile
+            if codec != "raw" or not isinstance(args, tuple) or args[0] not in RAW_MODES:
+                return None
+
+            left, top, right, bottom = extents
+            if left != 0 or right != self.width:
+                return None
+
+            rawmode, stride, orientation = (tuple(args) + (0, 1))[:3]
+            bytesPerPixel, channels = RAW_MODES[rawmode]
+            stride = stride or self.width * bytesPerPixel
+            tiles.append((top, bottom, offset, stride, orientation, bytesPerPixel, channels))
+
+        return tiles
+
+    def ReadRows(self, top, out: np.ndarray):
+        rows = min(out.shape[0], self.height - top)
+
+        if self.tiles is None:
+            out[:rows, :self.width] = self.imgMatrix[top:top + rows]
+            return rows
+
+        with open(self.imgAddr, 'rb') as f:
+            for row in range(top, top + rows):
+                tileTop, tileBottom, offset, stride, orientation, bytesPerPixel, channels = next(tile for tile in self.tiles if tile[0] <= row < tile[1])
+                fileRow = row - tileTop if orientation >= 0 else tileBottom - 1 - row
+
+                f.seek(offset + fileRow * stride)
+                pixels = np.frombuffer(f.read(self.width * bytesPerPixel), dtype=np.uint8)
+                out[row - top, :self.width] = pixels.reshape(self.width, bytesPerPixel)[:, channels]
+
+        return rows
+
+def IterStripBlocks(reader: RowReader, stripRows=8, subsampling="4:4:4", quality=DEFAULT_QUALITY, progress=None, dct=DEFAULT_DCT):
+    strip = np.empty((stripRows, reader.width, reader.channels), dtype=np.uint8)
+    # every strip is converted into the same buffer
+    ycbcrBuffer = np.empty(strip.shape, dtype=np.int8)
+
+    for top in range(0, reader.height, stripRows):
+        # the consumer asks for the next strip once it is done with this one, so rows up to top are finished
+        if progress is not None:
+            progress(top, reader.height)
+
+        # the last strip may end inside an MCU row, SplitMCUs replicates its edges like the whole image path
+        rows = reader.ReadRows(top, strip)
+
+        yield tools.TransformBlocks(tools.TransformToYCbCr(strip[:rows], ycbcrBuffer[:rows]), subsampling, quality, dct=dct)
+
+    if progress is not None:
+        progress(reader.height, reader.height)
+
+def IterStripDCAC(reader: RowReader, stripRows=8, subsampling="4:4:4", quality=DEFAULT_QUALITY, progress=None, dct=DEFAULT_DCT, restartInterval=0):
+    components = tools.MCUComponents(subsampling, reader.channels)
+    previousDC = None
+    firstMCU = 0
+
+    for zigzagBlocks in IterStripBlocks(reader, stripRows, subsampling, quality, progress, dct):
+        dcValues = zigzagBlocks[:, :, 0]
+        dcMatrix = tools.CalDCDifferences(dcValues, restartInterval, components, previousDC, firstMCU)
+        previousDC = tools.LastDC(dcValues, components)
+        firstMCU += dcValues.shape[0]
+
+        yield dcMatrix, np.ascontiguousarray(zigzagBlocks[:, :, 1:])
+
+def CalStreamingStatistics(reader: RowReader, stripRows=8, subsampling="4:4:4", quality=DEFAULT_QUALITY, progress=None, dct=DEFAULT_DCT, restartInterval=0) -> SymbolStatistics:
+    components = tools.MCUComponents(subsampling, reader.channels)
+    dcHistograms, acHistograms = 0, 0
+    for dcMatrix, acMatrix in IterStripDCAC(reader, stripRows, subsampling, quality, progress, dct, restartInterval):
+        statistics = CalSymbolStatistics(dcMatrix, acMatrix, components)
+        dcHistograms = dcHistograms + statistics.dcHistograms
+        acHistograms = acHistograms + statistics.acHistograms
+
+    return SymbolStatistics(dcHistograms, acHistograms)
+
+def IterRestartSegments(strips, mcuTables, dcLookup, acLookup, restartInterval):
+    # only whole restart intervals are encoded, the MCUs of an unfinished one wait for the next strip
+    def Segments(dcMatrix, acMatrix):
+        tableIds = np.tile(mcuTables, dcMatrix.shape[0])
+        return EncodeSegments(dcMatrix.reshape(-1), acMatrix.reshape(-1, acMatrix.shape[-1]), tableIds, dcLookup, acLookup, restartInterval * dcMatrix.shape[1])
+
+    pendingDC = pendingAC = None
+    for dcMatrix, acMatrix in strips:
+        if pendingDC is not None:
+            dcMatrix, acMatrix = np.concatenate((pendingDC, dcMatrix)), np.concatenate((pendingAC, acMatrix))
+        complete = dcMatrix.shape[0] // restartInterval * restartInterval
+        pendingDC, pendingAC = dcMatrix[complete:], acMatrix[complete:]
+        if complete > 0:
+            yield from Segments(dcMatrix[:complete], acMatrix[:complete])
+
+    # the last interval of the image may be short
+    if pendingDC is not None and pendingDC.shape[0] > 0:
+        yield from Segments(pendingDC, pendingAC)
+
+def EncodeStrips(reader: RowReader, tables, stripRows=8, subsampling="4:4:4", quality=DEFAULT_QUALITY, progress=None, dct=DEFAULT_DCT, restartInterval=0):
+    dcLookup, acLookup = tables.CalLookups()
+    mcuTables = COMPONENT_TABLES[list(tools.MCUComponents(subsampling, reader.channels))]
+    strips = IterStripDCAC(reader, stripRows, subsampling, quality, progress, dct, restartInterval)
+
+    if restartInterval <= 0:
+        packer = BitPacker()
+        for dcMatrix, acMatrix in strips:
+            tableIds = np.tile(mcuTables, dcMatrix.shape[0])
+            yield from EncodeScanChunks(dcMatrix.reshape(-1), acMatrix.reshape(-1, acMatrix.shape[-1]), tableIds, dcLookup, acLookup, packer)
+
+        yield PadScan(packer)
+        return
+
+    for index, segment in enumerate(IterRestartSegments(strips, mcuTables, dcLookup, acLookup, restartInterval)):
+        if index > 0:
+            yield RestartMarker.ForInterval(index - 1)
+        yield segment
+
+def CompressionImgStreaming(imgAddr, outputAddr = ".jpg", optimize = False, stripRows = 8, subsampling = "4:4:4", quality = DEFAULT_QUALITY, stats = None, progress = None, dct = DEFAULT_DCT, restartInterval = 0):
+    mcuHeight, mcuWidth = tools.MCUSize(subsampling)
+    if stripRows <= 0 or stripRows % mcuHeight != 0:
+        raise ValueError(f"stripRows should be a positive multiple of {mcuHeight}")
+
+    reader = RowReader(imgAddr)
+    components = tools.MCUComponents(subsampling, reader.channels)
+    if reader.channels == 1:
+        # a grayscale image has nothing to subsample
+        subsampling = "4:4:4"
+        mcuHeight, mcuWidth = tools.MCUSize(subsampling)
+    rows, cols = -(-reader.height // mcuHeight) * mcuHeight, -(-reader.width // mcuWidth) * mcuWidth
+
+    # progress(done, total) counts image rows, over both passes when optimized tables need a counting pass first;
+    # raising from it aborts the encode
+    countProgress = encodeProgress = progress
+    if progress is not None and optimize:
+        countProgress = lambda done, total: progress(done, 2 * total)
+        encodeProgress = lambda done, total: progress(total + done, 2 * total)
+
+    # optimized tables need a first pass over the strips to count symbols
+    with Stage(stats, "CalSymbolStatistics"):
+        statistics = CalStreamingStatistics(reader, stripRows, subsampling, quality, countProgress, dct, restartInterval) if optimize else None
+    tables = Huffman(None, None, components).CalDCACCode(useDefault=not optimize, statistics=statistics)
+
+    if stats is not None:
+        stats.blockCount = rows // mcuHeight * (cols // mcuWidth) * len(components)
+        # with the default tables there is no counting pass, so no symbols are reported
+        if statistics is not None:
+            stats.RecordSymbols(statistics, tables, components)
+
+    # every strip is read, transformed and entropy coded while the scan is written
+    with Stage(stats, "WriteJpeg"):
+        filesaver.WriteJpeg(EncodeStrips(reader, tables, stripRows, subsampling, quality, encodeProgress, dct, restartInterval), tables, *QuantizationTables(quality), reader.height, reader.width, outputAddr, restartInterval, subsampling, stats=stats, num_components=reader.channels)
+
+    return os.stat(imgAddr).st_size / 1024, os.stat(outputAddr).st_size / 1024
@@ -1,21 +1,25 @@
+import io
 from PIL import Image
 import numpy as np
 import os
-import cv2
-from . import filesaver
+from . import bmpreader, colorconvert, dctbackends, fastdct, filesaver, parallel, streaming
+from .dctbackends import DEFAULT_DCT
+from .quantization import DEFAULT_QUALITY, ZIGZAG_ORDER, QuantizationTables
 from .huffman import Huffman, HuffmanTable
+from .instrumentation import EncodeStats, Recording, Stage
+from .progressive import EncodeProgressive, ScanScript
+from .statistics import CalSymbolStatistics
 
-# LUMINANCE_QUANTIZATION_TABLE = np.array([
-#     [16, 11, 10, 16, 24, 40, 51, 61],
-#     [12, 12, 14, 19, 26, 58, 60, 55],
-#     [14, 13, 16, 24, 40, 57, 69, 56],
-#     [14, 17, 22, 29, 51, 87, 80, 62],
-#     [18, 22, 37, 56, 68, 109, 103, 77],
-#     [24, 35, 55, 64, 81, 104, 113, 92],
-#     [49, 64, 78, 87, 103, 121, 120, 101],
-#     [72, 92, 95, 98, 112, 100, 103, 99]
-# ])
+# the float DCT backends are followed by QuantizeBlocks, cv2 unless another is asked for; auto opts in to picking
+# the fastest of them on this host, aan is the integer DCT of fastdct with quantization folded in
+DCT_ENGINES = ("auto", *dctbackends.BACKENDS, "aan")
 
+# transparent pixels are blended onto this level, as they show on a white page
+ALPHA_BACKGROUND = 255
+# PIL modes that hold one gray channel and are encoded as a single component
+GRAYSCALE_MODES = ("1", "L", "I", "I;16", "I;16B", "I;16L", "F")
+
+# the tables of DEFAULT_QUALITY, other qualities are scaled by QuantizationTables
 LUMINANCE_QUANTIZATION_TABLE = np.array([
     [3, 2, 2, 3, 5, 8, 10, 12],
     [2, 2, 3, 4, 5, 12, 12, 11],
@@ -27,17 +31,6 @@ LUMINANCE_QUANTIZATION_TABLE = np.array([
     [14, 18, 19, 20, 22, 20, 21, 20]
 ])
 
-# CHROMINANCE_QUANTIZATION_TABLE = np.array([
-#     [17, 18, 24, 47, 99, 99, 99, 99],
-#     [18, 21, 26, 66, 99, 99, 99, 99],
-#     [24, 26, 56, 99, 99, 99, 99, 99],
-#     [47, 66, 99, 99, 99, 99, 99, 99],
-#     [99, 99, 99, 99, 99, 99, 99, 99],
-#     [99, 99, 99, 99, 99, 99, 99, 99],
-#     [99, 99, 99, 99, 99, 99, 99, 99],
-#     [99, 99, 99, 99, 99, 99, 99, 99]
-# ])
-
 CHROMINANCE_QUANTIZATION_TABLE = np.array([
     [3, 4, 5, 9, 20, 20, 20, 20],
     [4, 4, 5, 13, 20, 20, 20, 20],
@@ -49,39 +42,27 @@ CHROMINANCE_QUANTIZATION_TABLE = np.array([
     [20, 20, 20, 20, 20, 20, 20, 20]
 ])
 
-def Padding(img: np.ndarray) -> np.ndarray:
-    height, width = img.shape[:2]
-    if (height % 8 != 0):
-        height = height // 8 * 8 + 8
-    if (width % 8 != 0):
-        width = width // 8 * 8 + 8
-
-    padImage = np.zeros((height, width, 3), dtype=np.uint8)
-    padImage[:height,:width] = img
-
-    return padImage
+def TransformRgbToYCbCr(rgbImg: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    # fixed point lookup tables in chunks of rows, without the float64 temporaries of a matrix product; the int8
+    # samples come out level shifted by -128, as the DCT takes them
+    return colorconvert.RgbToYCbCr(rgbImg, out)
 
-def TransformRgbToYCbCr(rgbImg: np.ndarray) -> np.ndarray:
-    transform_matrix = np.array([
-        [    0.299,     0.587,     0.114],
-        [-0.168736, -0.331264,       0.5],
-        [      0.5, -0.418688, -0.081312]])
-    
-    offset = np.array([0, 128, 128])
-    ycbcrImg = rgbImg @ transform_matrix.T + offset
-    ycbcrImg = np.clip(ycbcrImg, 0, 255)
-    ycbcrImg = np.round(ycbcrImg)
+def TransformToYCbCr(img: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    # the level shifted samples of any image: YCbCr of three channels, the gray level of one
+    if img.shape[2] == 1:
+        return colorconvert.LevelShift(img, out)
 
-    return ycbcrImg.astype(np.uint8)
+    return TransformRgbToYCbCr(img, out)
 
 def TransformDCT(img: np.ndarray) -> np.ndarray:
-    return cv2.dct(np.float32(img))
+    return dctbackends.Cv2DCT(img[None, :, :, None])[0, :, :, 0]
 
-def Quantize(block: np.ndarray, type: str) -> np.ndarray:
+def Quantize(block: np.ndarray, type: str, quality = DEFAULT_QUALITY) -> np.ndarray:
+    luminance, chrominance = QuantizationTables(quality)
     if type == "luminance":
-        q = LUMINANCE_QUANTIZATION_TABLE
+        q = luminance.table
     elif type == "chrominance":
-        q = CHROMINANCE_QUANTIZATION_TABLE
+        q = chrominance.table
     else:
         raise ValueError("type should be either 'luminance' or 'chrominance'")
 
@@ -118,46 +99,323 @@ def ZigZag(block: np.ndarray) -> np.ndarray:
 
     return np.array(zigzag)
 
-def CompressionImg(imgAddr, outputAddr = ".jpg") -> np.ndarray:
-    img = Image.open(imgAddr)
-    imgMatrix = np.array(img)
-    padImg = Padding(imgMatrix)
-    ycbcrImg = TransformRgbToYCbCr(padImg)
+def SplitBlocks(img: np.ndarray) -> np.ndarray:
+    rows, cols, channels = img.shape
+    blocks = img.reshape(rows // 8, 8, cols // 8, 8, channels).swapaxes(1, 2)
+
+    return blocks.reshape(-1, 8, 8, channels)
+
+def TransformDCTBlocks(blocks: np.ndarray, backend = "cv2") -> np.ndarray:
+    return dctbackends.TransformDCTBlocks(blocks, backend)
+
+def QuantizeBlocks(blocks: np.ndarray, types, quality = DEFAULT_QUALITY) -> np.ndarray:
+    luminance, chrominance = QuantizationTables(quality)
+    reciprocals = []
+    for type in types:
+        if type == "luminance":
+            reciprocals.append(luminance.reciprocal)
+        elif type == "chrominance":
+            reciprocals.append(chrominance.reciprocal)
+        else:
+            raise ValueError("type should be either 'luminance' or 'chrominance'")
+
+    return (blocks * np.stack(reciprocals, axis=-1)).round().astype(np.int32)
+
+def ZigZagBlocks(blocks: np.ndarray) -> np.ndarray:
+    count, _, _, channels = blocks.shape
+
+    return blocks.transpose(0, 3, 1, 2).reshape(count, channels, 64)[:, :, ZIGZAG_ORDER]
+
+def MCUComponents(subsampling = "4:4:4", numComponents = 3) -> tuple:
+    # the luminance blocks of an MCU in raster order, then one Cb and one Cr block; a grayscale MCU is one block
+    if numComponents == 1:
+        return (0,)
+    h, v = filesaver.SAMPLING_FACTORS[subsampling]
+
+    return (0,) * (h * v) + (1, 2)
+
+def MCUSize(subsampling = "4:4:4") -> tuple:
+    h, v = filesaver.SAMPLING_FACTORS[subsampling]
+
+    return 8 * v, 8 * h
+
+def DownsampleChroma(chroma: np.ndarray, h, v) -> np.ndarray:
+    rows, cols, channels = chroma.shape
+    boxes = chroma.reshape(rows // v, v, cols // h, h, channels)
+
+    return boxes.mean(axis=(1, 3)).round().astype(chroma.dtype)
+
+def ReplicateEdges(img: np.ndarray, rows, cols) -> np.ndarray:
+    # repeats the last row and column out to rows x cols, a flat border costs no AC bits where black would
+    height, width = img.shape[:2]
+
+    return np.pad(img, ((0, rows - height), (0, cols - width), (0, 0)), mode="edge")
+
+def SplitMCUs(ycbcrImg: np.ndarray, subsampling = "4:4:4") -> np.ndarray:
+    # the image may end inside an MCU; whole MCUs are split straight from it and only the partial MCUs of the
+    # last row and column are built from an edge replicated copy of that strip
+    mcuHeight, mcuWidth = MCUSize(subsampling)
+    height, width, channels = ycbcrImg.shape
+    fullRows, fullCols = height // mcuHeight * mcuHeight, width // mcuWidth * mcuWidth
+    if fullRows == height and fullCols == width:
+        return SplitWholeMCUs(ycbcrImg, subsampling)
+
+    mcuRows, mcuCols = -(-height // mcuHeight), -(-width // mcuWidth)
+    slots = len(MCUComponents(subsampling, channels))
+    mcus = np.empty((mcuRows, mcuCols, 8, 8, slots), dtype=ycbcrImg.dtype)
+
+    fullMcuRows, fullMcuCols = fullRows // mcuHeight, fullCols // mcuWidth
+    if fullMcuRows > 0 and fullMcuCols > 0:
+        mcus[:fullMcuRows, :fullMcuCols] = SplitWholeMCUs(ycbcrImg[:fullRows, :fullCols], subsampling).reshape(fullMcuRows, fullMcuCols, 8, 8, slots)
+    if fullCols < width and fullMcuRows > 0:
+        rightEdge = ReplicateEdges(ycbcrImg[:fullRows, fullCols:], fullRows, mcuWidth)
+        mcus[:fullMcuRows, fullMcuCols] = SplitWholeMCUs(rightEdge, subsampling).reshape(fullMcuRows, 8, 8, slots)
+    if fullRows < height:
+        bottomEdge = ReplicateEdges(ycbcrImg[fullRows:], mcuHeight, mcuCols * mcuWidth)
+        mcus[fullMcuRows] = SplitWholeMCUs(bottomEdge, subsampling).reshape(mcuCols, 8, 8, slots)
+
+    return mcus.reshape(-1, 8, 8, slots)
+
+def SplitWholeMCUs(ycbcrImg: np.ndarray, subsampling = "4:4:4") -> np.ndarray:
+    h, v = filesaver.SAMPLING_FACTORS[subsampling]
+    if h == v == 1:
+        return SplitBlocks(ycbcrImg)
 
     rows, cols = ycbcrImg.shape[:2]
+    luma = ycbcrImg[:, :, 0].reshape(rows // (8 * v), v, 8, cols // (8 * h), h, 8)
+    luma = luma.transpose(0, 3, 2, 5, 1, 4).reshape(-1, 8, 8, v * h)
+    chroma = SplitBlocks(DownsampleChroma(ycbcrImg[:, :, 1:], h, v))
+
+    return np.concatenate((luma, chroma), axis=-1)
 
-    if rows % 8 == cols % 8 == 0:
-        blocksCount = rows // 8 * cols // 8
+def CheckDCT(dct):
+    if dct not in DCT_ENGINES:
+        raise ValueError(f"dct should be one of {', '.join(DCT_ENGINES)}")
+
+def TransformBlocks(ycbcrImg: np.ndarray, subsampling = "4:4:4", quality = DEFAULT_QUALITY, stats = None, dct = DEFAULT_DCT) -> np.ndarray:
+    types = ["luminance" if component == 0 else "chrominance" for component in MCUComponents(subsampling, ycbcrImg.shape[2])]
+    with Stage(stats, "SplitMCUs"):
+        blocks = SplitMCUs(ycbcrImg, subsampling)
+
+    if dct == "aan":
+        with Stage(stats, "TransformDCTQuantize"):
+            quantBlocks = fastdct.TransformQuantizeBlocks(blocks, types, quality)
     else:
-        raise ValueError("Image dimensions should be divisible by 8")
-    
-    dcMatrix = np.zeros((blocksCount, 3), dtype=np.int32)
-    acMatrix = np.zeros((blocksCount, 3, 63), dtype=np.int32)
-
-    previousDC = np.zeros(3, dtype=np.int32)
-    
-    for i in range(0, rows, 8):
-        for j in range(0, cols, 8):
-            try:
-                blockIndex += 1
-            except NameError:
-                blockIndex = 0
-
-            for k in range(3):
-                block = ycbcrImg[i:i+8, j:j+8, k]
-                dctMatrix  = TransformDCT(block)
-
-                quantMatrix = Quantize(dctMatrix, "luminance" if k == 0 else "chrominance")
-                zigzagMatrix = ZigZag(quantMatrix)
-
-                dcDifference = zigzagMatrix[0] - previousDC[k]
-                dcMatrix[blockIndex, k] = dcDifference
-                previousDC[k] = zigzagMatrix[0]
-                acMatrix[blockIndex, k, :] = zigzagMatrix[1:]
-
-    huffman = Huffman(dcMatrix, acMatrix)
-    bitStream, tables = huffman.EncodeDCAC(useDefault=True)
-
-    filesaver.WriteJpeg(bitStream, tables, LUMINANCE_QUANTIZATION_TABLE, CHROMINANCE_QUANTIZATION_TABLE, rows, cols, outputAddr)
-
-    return os.stat(imgAddr).st_size / 1024, os.stat(outputAddr).st_size / 1024
+        with Stage(stats, "TransformDCT"):
+            dctBlocks = TransformDCTBlocks(blocks, dct)
+        with Stage(stats, "Quantize"):
+            quantBlocks = QuantizeBlocks(dctBlocks, types, quality)
+
+    with Stage(stats, "ZigZag"):
+        return ZigZagBlocks(quantBlocks)
+
+def LastDC(dcValues: np.ndarray, components = (0, 1, 2)) -> np.ndarray:
+    lastDC = np.zeros(max(components) + 1, dtype=np.int32)
+    for slot, component in enumerate(components):
+        lastDC[component] = dcValues[-1, slot]
+
+    return lastDC
+
+def CalDCDifferences(dcValues: np.ndarray, restartInterval = 0, components = (0, 1, 2), previousDC = None, firstMCU = 0) -> np.ndarray:
+    dcMatrix = np.empty(dcValues.shape, dtype=np.int32)
+    components = np.asarray(components)
+
+    # each component is predicted from its own previous block, in scan order
+    for component in np.unique(components):
+        slots = np.nonzero(components == component)[0]
+        values = dcValues[:, slots].reshape(-1)
+        differences = np.diff(values, prepend=0 if previousDC is None else previousDC[component])
+
+        if restartInterval > 0:
+            # DC prediction starts over at the first MCU of every restart interval, counted from the start of the
+            # scan when dcValues is a strip that begins at firstMCU
+            step = restartInterval * slots.size
+            start = -firstMCU % restartInterval * slots.size
+            differences[start::step] = values[start::step]
+
+        dcMatrix[:, slots] = differences.reshape(-1, slots.size)
+
+    return dcMatrix
+
+def LoadImage(imgAddr) -> np.ndarray:
+    # uncompressed BMPs are mapped straight from the file instead of being decoded into a new array
+    imgMatrix = bmpreader.TryReadBmp(imgAddr)
+    if imgMatrix is not None:
+        return imgMatrix
+
+    return ToImageArray(Image.open(imgAddr))
+
+def CompositeAlpha(pixels: np.ndarray, alpha: np.ndarray) -> np.ndarray:
+    # JPEG has no alpha, so pixels are blended onto ALPHA_BACKGROUND; the sum never passes 255 * 255 + 127
+    alpha = alpha.astype(np.uint16)
+    if pixels.ndim == 3:
+        alpha = alpha[:, :, None]
+    blended = pixels * alpha + ALPHA_BACKGROUND * (255 - alpha) + 127
+
+    return (blended // 255).astype(np.uint8)
+
+def PaletteToArray(image: Image.Image) -> np.ndarray:
+    # the palette is looked up in numpy, and a palette of grays gives a grayscale image
+    if "transparency" in image.info or image.palette.mode == "RGBA":
+        rgba = np.asarray(image.convert("RGBA"))
+        return CompositeAlpha(rgba[:, :, :3], rgba[:, :, 3])
+
+    palette = np.zeros((256, 3), dtype=np.uint8)
+    colors = np.array(image.getpalette("RGB"), dtype=np.uint8).reshape(-1, 3)
+    palette[:len(colors)] = colors
+    indices = np.asarray(image)
+
+    if (palette[:, 0] == palette[:, 1]).all() and (palette[:, 1] == palette[:, 2]).all():
+        return palette[:, 0][indices]
+
+    return palette[indices]
+
+def PilToArray(image: Image.Image) -> np.ndarray:
+    if image.mode in ("L", "RGB"):
+        return np.asarray(image)
+    if image.mode == "P":
+        return PaletteToArray(image)
+    if image.mode in ("LA", "RGBA"):
+        pixels = np.asarray(image)
+        return CompositeAlpha(pixels[:, :, :-1].squeeze(axis=2) if image.mode == "LA" else pixels[:, :, :-1], pixels[:, :, -1])
+    if image.mode in GRAYSCALE_MODES:
+        return GrayToArray(image)
+
+    return np.asarray(image.convert("RGB"))
+
+def GrayToArray(image: Image.Image) -> np.ndarray:
+    # convert("L") clips wider gray modes instead of scaling them, so they are brought to 8 bits here
+    if image.mode in ("1", "L"):
+        return np.asarray(image.convert("L"))
+    pixels = np.asarray(image)
+    if image.mode.startswith("I;16"):
+        return (pixels >> 8).astype(np.uint8)
+
+    # I and F carry no range of their own: values up to 255 are kept, 16 bit values are scaled down and float
+    # values up to 1 are stretched to 255
+    low, high = (pixels.min(), pixels.max()) if pixels.size else (0, 0)
+    if low < 0 or high > 65535:
+        raise ValueError(f"{image.mode} image values should lie between 0 and 65535, got {low} to {high}")
+    if image.mode == "F":
+        pixels = pixels * 255 if high <= 1 else pixels / 256 if high > 255 else pixels
+        return np.clip(np.round(pixels), 0, 255).astype(np.uint8)
+
+    return (pixels >> 8 if high > 255 else pixels).astype(np.uint8)
+
+def ToImageArray(image) -> np.ndarray:
+    # (height, width) for grayscale and (height, width, 3) RGB for everything else; PIL images of any mode are
+    # converted, arrays may be gray, RGB or RGBA
+    if isinstance(image, Image.Image):
+        return PilToArray(image)
+
+    imgMatrix = np.asarray(image)
+    if imgMatrix.dtype != np.uint8:
+        raise ValueError(f"Image should be uint8, got {imgMatrix.dtype}")
+    if imgMatrix.ndim == 3 and imgMatrix.shape[2] == 1:
+        return imgMatrix[:, :, 0]
+    if imgMatrix.ndim == 3 and imgMatrix.shape[2] == 4:
+        return CompositeAlpha(imgMatrix[:, :, :3], imgMatrix[:, :, 3])
+    if imgMatrix.ndim != 2 and (imgMatrix.ndim != 3 or imgMatrix.shape[2] != 3):
+        raise ValueError(f"Image should be a (height, width) gray or (height, width, 3 or 4) color array, got shape {imgMatrix.shape}")
+
+    return imgMatrix
+
+def CheckProgressive(progressive, restartInterval = 0, workers = 1, stripRows = 0, numComponents = 3):
+    # every scan walks the whole image, so the coefficients are kept in one process and no restart markers are written
+    if not progressive:
+        return None
+    if restartInterval > 0 or workers > 1 or stripRows > 0:
+        raise ValueError("progressive encoding does not combine with restartInterval, workers or stripRows")
+
+    return ScanScript(progressive, numComponents)
+
+def EncodeImage(f, imgMatrix: np.ndarray, optimize = False, restartInterval = 0, workers = 1, subsampling = "4:4:4", quality = DEFAULT_QUALITY, stats: EncodeStats = None, dct = DEFAULT_DCT, progressive = False) -> int:
+    if subsampling not in filesaver.SAMPLING_FACTORS:
+        raise ValueError(f"subsampling should be one of {', '.join(filesaver.SAMPLING_FACTORS)}")
+    CheckDCT(dct)
+    # a grayscale image is a single luminance component, with nothing to subsample or convert
+    numComponents = 1 if imgMatrix.ndim == 2 else 3
+    if numComponents == 1:
+        imgMatrix = imgMatrix[:, :, None]
+        subsampling = "4:4:4"
+    scans = CheckProgressive(progressive, restartInterval, workers, numComponents=numComponents)
+    # resolved here so parallel workers do not each measure the backends
+    dct = dctbackends.ResolveBackend(dct)
+    luminanceTable, chrominanceTable = QuantizationTables(quality)
+
+    if workers > 1:
+        return parallel.EncodeParallel(imgMatrix, f, workers, optimize, restartInterval, subsampling, quality, stats, dct)
+
+    # the image is not padded, SplitMCUs replicates the edges of partial MCUs and SOF carries the true size
+    with Stage(stats, "TransformRgbToYCbCr"):
+        ycbcrImg = TransformToYCbCr(imgMatrix)
+
+    height, width = ycbcrImg.shape[:2]
+    components = MCUComponents(subsampling, numComponents)
+
+    zigzagBlocks = TransformBlocks(ycbcrImg, subsampling, quality, stats, dct)
+    if scans is not None:
+        # the scans take the same coefficients, each one is entropy coded with its own tables as it is written
+        if stats is not None:
+            stats.blockCount = zigzagBlocks.shape[0] * zigzagBlocks.shape[1]
+        encodedScans = EncodeProgressive(zigzagBlocks, components, filesaver.SAMPLING_FACTORS[subsampling], height, width, scans)
+        with Stage(stats, "WriteJpeg"):
+            return filesaver.WriteProgressiveJpegTo(f, encodedScans, luminanceTable, chrominanceTable, height, width, subsampling, numComponents, stats)
+
+    with Stage(stats, "CalDCDifferences"):
+        dcMatrix = CalDCDifferences(zigzagBlocks[:, :, 0], restartInterval, components)
+        acMatrix = np.ascontiguousarray(zigzagBlocks[:, :, 1:])
+
+    huffman = Huffman(dcMatrix, acMatrix, components)
+    statistics = None
+    if stats is not None:
+        # counted once here, optimized tables are then built from the same histograms
+        with Stage(stats, "CalSymbolStatistics"):
+            statistics = CalSymbolStatistics(dcMatrix, acMatrix, components)
+        stats.blockCount = dcMatrix.size
+
+    with Stage(stats, "EncodeDCAC"):
+        scanChunks, tables = huffman.EncodeDCAC(useDefault=not optimize, restartInterval=restartInterval, statistics=statistics)
+    if stats is not None:
+        stats.RecordSymbols(statistics, tables, components)
+
+    # the scan is entropy coded lazily while it is written
+    with Stage(stats, "WriteJpeg"):
+        return filesaver.WriteJpegTo(f, scanChunks, tables, luminanceTable, chrominanceTable, height, width, restartInterval, subsampling, stats=stats, num_components=numComponents)
+
+def encode_to(image, fileobj, optimize = False, restartInterval = 0, workers = 1, subsampling = "4:4:4", quality = DEFAULT_QUALITY, stats: EncodeStats = None, dct = DEFAULT_DCT, progressive = False) -> int:
+    # encodes a gray, RGB or RGBA array or a PIL image into any binary stream and returns the bytes written
+    with Recording(stats):
+        return EncodeImage(fileobj, ToImageArray(image), optimize, restartInterval, workers, subsampling, quality, stats, dct, progressive)
+
+def encode(image, **options) -> bytes:
+    buffer = io.BytesIO()
+    encode_to(image, buffer, **options)
+
+    return buffer.getvalue()
+
+def CompressionImg(imgAddr, outputAddr = ".jpg", optimize = False, restartInterval = 0, workers = 1, stripRows = 0, subsampling = "4:4:4", quality = DEFAULT_QUALITY, stats: EncodeStats = None, progress = None, dct = DEFAULT_DCT, progressive = False) -> np.ndarray:
+    if subsampling not in filesaver.SAMPLING_FACTORS:
+        raise ValueError(f"subsampling should be one of {', '.join(filesaver.SAMPLING_FACTORS)}")
+    CheckDCT(dct)
+    CheckProgressive(progressive, restartInterval, workers, stripRows)
+    if stripRows > 0 and workers > 1:
+        raise ValueError("stripRows streams the image through one process and does not combine with workers")
+    if progress is not None and stripRows <= 0:
+        raise ValueError("progress is reported strip by strip, set stripRows as well")
+
+    # stats is filled in as the encode runs, without it every stage hook is a no-op
+    with Recording(stats):
+        # a strip height streams the image through the encoder instead of loading it whole, progress(done, total)
+        # is called with the image rows encoded so far and may raise to abort
+        if stripRows > 0:
+            return streaming.CompressionImgStreaming(imgAddr, outputAddr, optimize, stripRows, subsampling, quality, stats, progress, dct, restartInterval)
+
+        with Stage(stats, "LoadImage"):
+            imgMatrix = LoadImage(imgAddr)
+
+        # the output may be the BMP mapped above, so it only replaces that file once it is complete
+        with filesaver.OutputFile(outputAddr) as f:
+            outputSize = EncodeImage(f, imgMatrix, optimize, restartInterval, workers, subsampling, quality, stats, dct, progressive)
+
+    return os.stat(imgAddr).st_size / 1024, outputSize / 1024
@@ -0,0 +1,100 @@
+import os
+import sys
+import time
+import numpy as np
+from bitarray import bitarray
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Model.tools as tools
+from Model import filesaver
+from Model.huffman import Huffman
+
+IMAGE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Img", "lena.bmp")
+
+# symbol by symbol coder the vectorized engine replaced, kept here as the speed and output reference
+def ReferenceEncodeDC(bitStream: bitarray, dcVal, codes):
+    dcVal = int(dcVal)
+    size = dcVal.bit_length()
+    amplitude = dcVal if dcVal >= 0 else dcVal + (1 << size) - 1
+    bitStream.extend(codes.get(size, '') + (format(amplitude, f'0{size}b') if size else ''))
+
+def ReferenceEncodeAC(bitStream: bitarray, acList, codes):
+    run_length = 0
+    last_non_zero_index = np.nonzero(acList)[0][-1] if np.any(acList) else -1
+
+    for i in range(0, last_non_zero_index + 1):
+        val = int(acList[i])
+
+        if val == 0:
+            run_length += 1
+
+            if run_length > 15:
+                bitStream.extend(codes[0xF0])
+                run_length = 0
+        else:
+            size = int(np.ceil(np.log2(abs(val) + 1)))
+            bitStream.extend(codes[(run_length << 4) | size])
+
+            amplitude = val if val > 0 else val + (1 << size) - 1
+            bitStream.extend(format(amplitude, f'0{size}b'))
+
+            run_length = 0
+
+    if last_non_zero_index < len(acList) - 1:
+        bitStream.extend(codes[0])
+
+def ReferenceEncodeDCAC(dcMatrix, acMatrix, tables):
+    bitStream = bitarray()
+
+    for i in range(dcMatrix.shape[0]):
+        ReferenceEncodeDC(bitStream, dcMatrix[i, 0], tables.dcLuminanceCodes)
+        ReferenceEncodeAC(bitStream, acMatrix[i, 0, :], tables.acLuminanceCodes)
+        ReferenceEncodeDC(bitStream, dcMatrix[i, 1], tables.dcChrominanceCodes)
+        ReferenceEncodeAC(bitStream, acMatrix[i, 1, :], tables.acChrominanceCodes)
+        ReferenceEncodeDC(bitStream, dcMatrix[i, 2], tables.dcChrominanceCodes)
+        ReferenceEncodeAC(bitStream, acMatrix[i, 2, :], tables.acChrominanceCodes)
+
+    bitStream.extend('1' * (8 - len(bitStream) % 8))
+    byteStream = bitStream.tobytes()
+
+    return byteStream.replace(b'\xff', b'\xff\x00')
+
+def CalCoefficients(imgAddr):
+    ycbcrImg = tools.TransformRgbToYCbCr(np.array(Image.open(imgAddr)))
+    blocks = tools.QuantizeBlocks(tools.TransformDCTBlocks(tools.SplitMCUs(ycbcrImg)), ("luminance", "chrominance", "chrominance"))
+    zigzagBlocks = tools.ZigZagBlocks(blocks)
+
+    dcMatrix = np.diff(zigzagBlocks[:, :, 0], axis=0, prepend=0).astype(np.int32)
+    acMatrix = np.ascontiguousarray(zigzagBlocks[:, :, 1:])
+
+    return dcMatrix, acMatrix
+
+def Timeit(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+
+    return min(times), result
+
+def main(imgAddr=IMAGE_PATH, repeat=5):
+    dcMatrix, acMatrix = CalCoefficients(imgAddr)
+    huffman = Huffman(dcMatrix, acMatrix)
+    tables = huffman.CalDCACCode(useDefault=True)
+
+    referenceTime, referenceBytes = Timeit(lambda: ReferenceEncodeDCAC(dcMatrix, acMatrix, tables), repeat)
+    vectorTime, vectorBytes = Timeit(lambda: b''.join(map(filesaver.StuffBytes, huffman.EncodeDCAC(useDefault=True)[0])), repeat)
+
+    if vectorBytes != referenceBytes:
+        raise SystemExit("vectorized scan differs from the reference coder")
+
+    print(f"image:      {imgAddr} ({dcMatrix.shape[0]} blocks, {len(referenceBytes)} scan bytes)")
+    print(f"reference:  {referenceTime * 1000:8.1f} ms")
+    print(f"vectorized: {vectorTime * 1000:8.1f} ms")
+    print(f"speedup:    {referenceTime / vectorTime:8.1f}x")
+
+if __name__ == "__main__":
+    main(*sys.argv[1:2])
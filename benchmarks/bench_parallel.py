@@ -0,0 +1,46 @@
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Model.parallel import CompressionImgParallel
+
+IMAGE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Img", "lena.bmp")
+WORKER_COUNTS = (1, 2, 4, 8)
+
+def MakeImage(size):
+    return np.array(Image.open(IMAGE_PATH).convert("RGB").resize((size, size)))
+
+def main(size=4096, repeat=3):
+    imgMatrix = MakeImage(int(size))
+    print(f"image: {imgMatrix.shape[1]}x{imgMatrix.shape[0]}, cpus: {os.cpu_count()}")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        outputs = {}
+        times = {}
+        for workers in WORKER_COUNTS:
+            outputAddr = os.path.join(tmpdir, f"{workers}.jpg")
+            best = float("inf")
+            for _ in range(repeat):
+                start = time.perf_counter()
+                CompressionImgParallel(imgMatrix, outputAddr, workers)
+                best = min(best, time.perf_counter() - start)
+
+            times[workers] = best
+            with open(outputAddr, "rb") as f:
+                outputs[workers] = f.read()
+
+        if len(set(outputs.values())) != 1:
+            raise SystemExit("output differs between worker counts")
+
+        megapixels = imgMatrix.shape[0] * imgMatrix.shape[1] / 1e6
+        print(f"{'workers':>8} {'seconds':>9} {'MP/s':>8} {'speedup':>8}")
+        for workers in WORKER_COUNTS:
+            print(f"{workers:>8} {times[workers]:>9.3f} {megapixels / times[workers]:>8.2f} {times[1] / times[workers]:>7.2f}x")
+
+if __name__ == "__main__":
+    main(*sys.argv[1:2])
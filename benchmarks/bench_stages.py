@@ -0,0 +1,224 @@
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import numpy as np
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import Model.tools as tools
+from Model import fastdct, filesaver
+from Model.huffman import Huffman
+from Model.quantization import DEFAULT_QUALITY, QuantizationTables
+
+IMAGE_PATH = os.path.join(ROOT, "Img", "lena.bmp")
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# square synthetic images, then 8K UHD
+SYNTHETIC_SIZES = ((64, 64), (512, 512), (2048, 2048), (7680, 4320))
+STAGES = ("TransformRgbToYCbCr", "SplitMCUs", "TransformDCT", "Quantize", "DCTQuantizeAAN", "ZigZag",
+          "EncodeDCAC", "EncodeDCACOptimized", "WriteJpeg", "EndToEnd")
+COMPONENT_TYPES = ("luminance", "chrominance", "chrominance")
+
+def MakeSyntheticImage(width, height, seed=0):
+    # smooth gradients and ripples with a little noise, closer to a photo than plain noise
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    r = 128 + 100 * np.sin(x / 37) * np.cos(y / 53)
+    g = 255 * x / max(width - 1, 1)
+    b = 255 * y / max(height - 1, 1)
+    img = np.stack((r, g, b), axis=-1) + rng.normal(0, 6, (height, width, 3))
+
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+def EncodeChunks(huffman, useDefault):
+    scanChunks, tables = huffman.EncodeDCAC(useDefault=useDefault)
+
+    return list(scanChunks), tables
+
+def TimeRounds(funcs, repeat) -> dict:
+    # one untimed round pays for lazy imports and cold caches, then the stages take turns, one call each per round,
+    # so a few slow seconds on a busy host are spread over every stage instead of landing on one; the median of
+    # the rounds is what gets compared
+    for func in funcs.values():
+        func()
+
+    samples = {name: [] for name in funcs}
+    for _ in range(repeat):
+        for name, func in funcs.items():
+            start = time.perf_counter()
+            func()
+            samples[name].append(time.perf_counter() - start)
+
+    return {name: float(np.median(times)) for name, times in samples.items()}
+
+def BenchImage(imgAddr, repeat, tmpdir):
+    imgMatrix = tools.LoadImage(imgAddr)
+
+    # every stage runs on the output of the one before
+    ycbcrImg = tools.TransformRgbToYCbCr(imgMatrix)
+    blocks = tools.SplitMCUs(ycbcrImg)
+    dctBlocks = tools.TransformDCTBlocks(blocks)
+    quantBlocks = tools.QuantizeBlocks(dctBlocks, COMPONENT_TYPES)
+    zigzagBlocks = tools.ZigZagBlocks(quantBlocks)
+
+    dcMatrix = tools.CalDCDifferences(zigzagBlocks[:, :, 0])
+    acMatrix = np.ascontiguousarray(zigzagBlocks[:, :, 1:])
+    huffman = Huffman(dcMatrix, acMatrix)
+    scanChunks, tables = EncodeChunks(huffman, True)
+
+    rows, cols = imgMatrix.shape[:2]
+    outputAddr = os.path.join(tmpdir, "stage.jpg")
+    luminanceTable, chrominanceTable = QuantizationTables(DEFAULT_QUALITY)
+
+    times = TimeRounds({
+        "TransformRgbToYCbCr": lambda: tools.TransformRgbToYCbCr(imgMatrix),
+        # edge replicates the partial MCUs of sizes that are not a multiple of 8
+        "SplitMCUs": lambda: tools.SplitMCUs(ycbcrImg),
+        "TransformDCT": lambda: tools.TransformDCTBlocks(blocks),
+        "Quantize": lambda: tools.QuantizeBlocks(dctBlocks, COMPONENT_TYPES),
+        # the integer engine does both of the stages above in one
+        "DCTQuantizeAAN": lambda: fastdct.TransformQuantizeBlocks(blocks, COMPONENT_TYPES),
+        "ZigZag": lambda: tools.ZigZagBlocks(quantBlocks),
+        "EncodeDCAC": lambda: EncodeChunks(huffman, True),
+        "EncodeDCACOptimized": lambda: EncodeChunks(huffman, False),
+        "WriteJpeg": lambda: filesaver.WriteJpeg(scanChunks, tables, luminanceTable, chrominanceTable, rows, cols, outputAddr),
+        "EndToEnd": lambda: tools.CompressionImg(imgAddr, outputAddr),
+        # libjpeg at the same quality and 4:4:4, from the same file
+        "Pillow": lambda: SavePillow(imgAddr),
+    }, repeat)
+    pillowTime = times.pop("Pillow")
+
+    return {
+        "width": int(imgMatrix.shape[1]),
+        "height": int(imgMatrix.shape[0]),
+        "stages": times,
+        "bytes": os.path.getsize(outputAddr),
+        "pillow": {"seconds": pillowTime, "bytes": SavePillow(imgAddr)},
+    }
+
+def SavePillow(imgAddr):
+    buffer = io.BytesIO()
+    Image.open(imgAddr).convert("RGB").save(buffer, "JPEG", quality=DEFAULT_QUALITY, subsampling=0)
+
+    return buffer.tell()
+
+def RunSuite(sizes, repeat, includeLena=True):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        images = [("lena", IMAGE_PATH)] if includeLena else []
+        for width, height in sizes:
+            imgAddr = os.path.join(tmpdir, f"{width}x{height}.bmp")
+            Image.fromarray(MakeSyntheticImage(width, height)).save(imgAddr)
+            images.append((f"{width}x{height}", imgAddr))
+
+        for name, imgAddr in images:
+            results[name] = BenchImage(imgAddr, repeat, tmpdir)
+            PrintImage(name, results[name])
+
+    return {
+        "machine": {"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(), "cpus": os.cpu_count()},
+        "repeat": repeat,
+        "images": results,
+    }
+
+def PrintImage(name, result):
+    megapixels = result["width"] * result["height"] / 1e6
+    print(f"{name} ({result['width']}x{result['height']}, {result['bytes']} bytes)")
+    for stage in STAGES:
+        seconds = result["stages"][stage]
+        print(f"  {stage:<20} {seconds * 1000:>10.2f} ms {megapixels / seconds:>9.2f} MP/s")
+
+    pillow = result["pillow"]
+    print(f"  {'Pillow':<20} {pillow['seconds'] * 1000:>10.2f} ms {megapixels / pillow['seconds']:>9.2f} MP/s "
+          f"({pillow['bytes']} bytes, EndToEnd is {result['stages']['EndToEnd'] / pillow['seconds']:.1f}x slower)")
+
+def HostFactor(stages, baseStages) -> float:
+    # how much slower the host runs than when the baseline was recorded: the median over the stages of one image,
+    # a busy host slows all of them while a regression moves only a few and barely shifts the median
+    ratios = [seconds / baseStages[stage] for stage, seconds in stages.items() if baseStages.get(stage)]
+
+    return float(np.median(ratios)) if ratios else 1.0
+
+def CompareBaseline(current, baseline, tolerance, minDelta):
+    # a stage regresses when it is slower than its baseline, scaled by the host factor, by more than the tolerance
+    # and by more than minDelta seconds
+    regressions = []
+    for name, result in current["images"].items():
+        baseImage = baseline["images"].get(name)
+        if baseImage is None:
+            continue
+        hostFactor = HostFactor(result["stages"], baseImage["stages"])
+        for stage, seconds in result["stages"].items():
+            baseSeconds = baseImage["stages"].get(stage)
+            if baseSeconds is None:
+                continue
+            expected = baseSeconds * hostFactor
+            if seconds > expected * (1 + tolerance) and seconds - expected > minDelta:
+                regressions.append((name, stage, baseSeconds, seconds, hostFactor))
+
+    return regressions
+
+def ParseSize(text):
+    width, _, height = text.partition("x")
+
+    return int(width), int(height or width)
+
+def ParseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="Time every encoder stage and check it against a baseline.")
+    parser.add_argument("--sizes", nargs="*", type=ParseSize, default=list(SYNTHETIC_SIZES), help="synthetic image sizes, WIDTHxHEIGHT")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per stage after one untimed warm-up run")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown, 0.25 is 25%%")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0, help="ignore slowdowns smaller than this")
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = ParseArgs(argv)
+    current = RunSuite(args.sizes, args.repeat)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(current, f, indent=2)
+        print(f"baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"no baseline at {args.baseline}, run with --save-baseline first")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    regressions = CompareBaseline(current, baseline, args.tolerance, args.min_delta_ms / 1000)
+    if regressions:
+        # a slow spell of the host can outlast the rounds of one image, so a regression has to show up again
+        flagged = {(name, stage) for name, stage, *_ in regressions}
+        names = {name for name, _ in flagged}
+        print(f"re-measuring {', '.join(sorted(names))}")
+        again = RunSuite([(width, height) for width, height in args.sizes if f"{width}x{height}" in names], args.repeat, "lena" in names)
+        regressions = [regression for regression in CompareBaseline(again, baseline, args.tolerance, args.min_delta_ms / 1000) if regression[:2] in flagged]
+
+    for name, stage, baseSeconds, seconds, hostFactor in regressions:
+        print(f"REGRESSION {name} {stage}: {baseSeconds * 1000:.2f} ms -> {seconds * 1000:.2f} ms (host factor {hostFactor:.2f})")
+    if regressions:
+        return 1
+
+    print(f"no stage regressed beyond {args.tolerance:.0%} of {args.baseline}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,25 @@
+import io
 import os
+import queue
+import threading
 import tkinter as tk
 from tkinter import filedialog
 from tkinter import messagebox
+from tkinter import ttk
 from PIL import Image, ImageTk
 import Model.tools as tools
+from Model.instrumentation import EncodeStats
+from Model.quantization import DEFAULT_QUALITY
+
+# 背景壓縮每次處理的列數，也是進度條更新的間隔
+STRIP_ROWS = 64
+POLL_MS = 50
+# 滑桿停止拖動多久後才重新壓縮預覽
+PREVIEW_DEBOUNCE_MS = 150
+PREVIEW_SIZE = (300, 300)
+
+class EncodeCancelled(Exception):
+    pass
 
 class ImageCompressorApp:
     def __init__(self, root):
@@ -45,10 +61,22 @@ class ImageCompressorApp:
         self.save_label = tk.Label(self.left_frame, text="No save location selected")
         self.save_label.pack(pady=10)
 
+        # 品質滑桿，拖動時只重新壓縮預覽縮圖，存檔時才壓縮整張圖
+        self.quality_scale = tk.Scale(self.left_frame, from_=1, to=100, orient=tk.HORIZONTAL, length=200, label="Quality", command=self.on_quality_change)
+        self.quality_scale.set(DEFAULT_QUALITY)
+        self.quality_scale.pack(pady=10)
+
         # 添加壓縮按鈕
         self.compress_button = tk.Button(self.left_frame, text="Compress and Save", command=self.compress_image)
         self.compress_button.pack(pady=20)
 
+        # 壓縮進度與取消按鈕
+        self.progress_bar = ttk.Progressbar(self.left_frame, length=200, mode="determinate", maximum=1.0)
+        self.progress_bar.pack(pady=5)
+
+        self.cancel_button = tk.Button(self.left_frame, text="Cancel", command=self.cancel_compression, state=tk.DISABLED)
+        self.cancel_button.pack(pady=5)
+
         # 原始圖片預覽
         self.preview_label_original = tk.Label(self.original_frame, text="Original Image")
         self.preview_label_original.pack(pady=10)
@@ -79,6 +107,17 @@ class ImageCompressorApp:
         self.image_path = None
         self.save_path = None
 
+        # 預覽用的縮圖、原圖像素數與等待中的預覽排程
+        self.preview_source = None
+        self.full_pixels = 0
+        self.preview_job = None
+
+        # 背景壓縮的狀態，工作執行緒只寫入這些欄位，畫面由主執行緒輪詢更新
+        self.worker = None
+        self.cancel_event = threading.Event()
+        self.results = queue.Queue()
+        self.progress_value = 0.0
+
     # 選擇圖片
     def select_image(self):
         self.image_path = filedialog.askopenfilename(filetypes=[("Image files", "*.bmp;*.png")])
@@ -95,12 +134,48 @@ class ImageCompressorApp:
     def show_image_preview_original(self):
         try:
             image = Image.open(self.image_path)
-            image.thumbnail((300, 300))
+            self.full_pixels = image.width * image.height
+            image.thumbnail(PREVIEW_SIZE)
+            # 灰階與透明圖片照編碼器的方式轉換，估計的大小才準
+            self.preview_source = tools.ToImageArray(image)
             photo = ImageTk.PhotoImage(image)
             self.image_display_original.config(image=photo)
             self.image_display_original.image = photo
         except Exception as e:
             messagebox.showerror("Error", f"Failed to load image: {e}")
+            return
+
+        self.original_size_label.config(text=f"Original Image Size: {os.path.getsize(self.image_path) / 1024:.2f} KB")
+        self.update_preview()
+
+    # 滑桿每動一次就重設排程，停下來後才更新預覽
+    def on_quality_change(self, _value):
+        if self.preview_job is not None:
+            self.root.after_cancel(self.preview_job)
+        self.preview_job = self.root.after(PREVIEW_DEBOUNCE_MS, self.update_preview)
+
+    # 只在記憶體中壓縮縮圖，並依像素比例推估整張圖的檔案大小
+    def update_preview(self):
+        self.preview_job = None
+        if self.preview_source is None:
+            return
+
+        try:
+            stats = EncodeStats(traceMemory=False)
+            data = tools.encode(self.preview_source, quality=self.quality_scale.get(), stats=stats)
+            photo_compressed = ImageTk.PhotoImage(Image.open(io.BytesIO(data)))
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to preview compression: {e}")
+            return
+
+        self.image_display_compressed.config(image=photo_compressed)
+        self.image_display_compressed.image = photo_compressed
+
+        preview_pixels = self.preview_source.shape[0] * self.preview_source.shape[1]
+        estimated_size = (stats.headerBytes + (stats.fileBytes - stats.headerBytes) * self.full_pixels / preview_pixels) / 1024
+        original_size = os.path.getsize(self.image_path) / 1024
+        self.compressed_size_label.config(text=f"JPEG Image Size: ~{estimated_size:.2f} KB (estimated)")
+        self.ratio_label.config(text=f"Compression Ratio: ~{estimated_size / original_size * 100:.2f}% (estimated)")
 
     # 顯示壓縮圖片預覽
     def show_image_preview_compressed(self):
@@ -130,22 +205,80 @@ class ImageCompressorApp:
 
     # 壓縮圖片
     def compress_image(self):
-        if self.image_path and self.save_path:
-            try:
-                original_size, compressed_size = tools.CompressionImg(self.image_path, self.save_path)
-                if original_size and compressed_size:
-                    compression_ratio = (compressed_size / original_size) * 100
-                    self.original_size_label.config(text=f"Original Image Size: {original_size:.2f} KB")
-                    self.compressed_size_label.config(text=f"JPEG Image Size: {compressed_size:.2f} KB")
-                    self.ratio_label.config(text=f"Compression Ratio: {compression_ratio:.2f}%")
-                    self.show_image_preview_compressed()
-                else:
-                    self.ratio_label.config(text="Compression Ratio: Calculation error")
-                messagebox.showinfo("Info", f"Image compressed and saved to {self.save_path}")
-            except Exception as e:
-                messagebox.showerror("Error", f"Failed to compress image: {e}")
-        else:
+        if not (self.image_path and self.save_path):
             messagebox.showwarning("Warning", "No image selected or save location not set!")
+            return
+        if self.worker is not None:
+            return
+
+        self.cancel_event.clear()
+        self.progress_value = 0.0
+        self.progress_bar["value"] = 0.0
+        self.set_selection_state(tk.DISABLED)
+        self.cancel_button.config(state=tk.NORMAL)
+
+        self.worker = threading.Thread(target=self.run_compression, args=(self.image_path, self.save_path, self.quality_scale.get()), daemon=True)
+        self.worker.start()
+        self.root.after(POLL_MS, self.poll_compression)
+
+    # 在背景執行緒壓縮，不碰任何Tk元件
+    def run_compression(self, image_path, save_path, quality=DEFAULT_QUALITY):
+        try:
+            sizes = tools.CompressionImg(image_path, save_path, stripRows=STRIP_ROWS, quality=quality, progress=self.report_progress)
+            self.results.put(("done", sizes))
+        except EncodeCancelled:
+            self.results.put(("cancelled", None))
+        except Exception as e:
+            self.results.put(("error", e))
+
+    # 每壓完一段列就被呼叫，取消時丟出例外中止壓縮
+    def report_progress(self, done, total):
+        self.progress_value = done / total if total else 1.0
+        if self.cancel_event.is_set():
+            raise EncodeCancelled()
+
+    # 主執行緒輪詢進度與結果
+    def poll_compression(self):
+        self.progress_bar["value"] = self.progress_value
+
+        try:
+            status, result = self.results.get_nowait()
+        except queue.Empty:
+            self.root.after(POLL_MS, self.poll_compression)
+            return
+
+        self.worker = None
+        self.set_selection_state(tk.NORMAL)
+        self.cancel_button.config(state=tk.DISABLED)
+
+        if status == "done":
+            self.progress_bar["value"] = 1.0
+            self.finish_compression(*result)
+        elif status == "cancelled":
+            self.progress_bar["value"] = 0.0
+            messagebox.showinfo("Info", "Compression cancelled")
+        else:
+            messagebox.showerror("Error", f"Failed to compress image: {result}")
+
+    # 壓縮中不能更換圖片或儲存路徑
+    def set_selection_state(self, state):
+        for button in (self.select_button, self.save_button, self.compress_button):
+            button.config(state=state)
+
+    def cancel_compression(self):
+        self.cancel_event.set()
+        self.cancel_button.config(state=tk.DISABLED)
+
+    def finish_compression(self, original_size, compressed_size):
+        if original_size and compressed_size:
+            compression_ratio = (compressed_size / original_size) * 100
+            self.original_size_label.config(text=f"Original Image Size: {original_size:.2f} KB")
+            self.compressed_size_label.config(text=f"JPEG Image Size: {compressed_size:.2f} KB")
+            self.ratio_label.config(text=f"Compression Ratio: {compression_ratio:.2f}%")
+            self.show_image_preview_compressed()
+        else:
+            self.ratio_label.config(text="Compression Ratio: Calculation error")
+        messagebox.showinfo("Info", f"Image compressed and saved to {self.save_path}")
 
 if __name__ == "__main__":
     root = tk.Tk()
@@ -0,0 +1,173 @@
+import asyncio
+import io
+import json
+import os
+import sys
+import threading
+import unittest
+from unittest import mock
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Model import dctbackends
+from Model.server import EncodeServer, Lanes
+
+SMALL_PIXELS = 64 * 64
+
+def ImageBytes(width, height):
+    pixels = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    output = io.BytesIO()
+    Image.fromarray(pixels).save(output, format="PNG")
+
+    return output.getvalue()
+
+def EncodeRequest(data, query="quality=75"):
+    return f"POST /encode?{query} HTTP/1.1\r\nContent-Length: {len(data)}\r\n\r\n".encode() + data
+
+async def ReadResponse(reader):
+    head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+    status = int(head[0].split(" ")[1])
+    headers = {}
+    for line in head[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+
+    return status, headers, await reader.readexactly(int(headers["content-length"]))
+
+class ServerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = EncodeServer(workers=1, maxQueue=1, smallPixels=SMALL_PIXELS)
+        listener = await self.server.Start(port=0)
+        self.port = listener.sockets[0].getsockname()[1]
+        self.connections = []
+
+    async def asyncTearDown(self):
+        for _, writer in self.connections:
+            writer.close()
+        await self.server.Close()
+
+    async def Connect(self):
+        connection = await asyncio.open_connection("127.0.0.1", self.port)
+        self.connections.append(connection)
+
+        return connection
+
+    async def HoldDispatchers(self):
+        # nothing leaves the lanes until a dispatcher is started again
+        for dispatcher in self.server.dispatchers:
+            dispatcher.cancel()
+        await asyncio.gather(*self.server.dispatchers, return_exceptions=True)
+        self.server.dispatchers = []
+
+    def ReleaseDispatcher(self):
+        self.server.dispatchers.append(asyncio.create_task(self.server.Dispatch(smallOnly=False)))
+
+    async def WaitQueued(self, small=0, large=0):
+        while (len(self.server.lanes.small), len(self.server.lanes.large)) != (small, large):
+            await asyncio.sleep(0.01)
+
+    async def test_keep_alive_after_error_without_body(self):
+        reader, writer = await self.Connect()
+        writer.write(b"GET /missing HTTP/1.1\r\n\r\nGET /health HTTP/1.1\r\n\r\n")
+
+        status, headers, _ = await ReadResponse(reader)
+        self.assertEqual(status, 404)
+        self.assertEqual(headers["connection"], "keep-alive")
+        status, _, body = await ReadResponse(reader)
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)["workers"], 1)
+
+    async def test_error_before_body_closes_connection(self):
+        # the body is never read, so a request hidden in it must not be served
+        reader, writer = await self.Connect()
+        smuggled = b"GET /health HTTP/1.1\r\n\r\n"
+        writer.write(EncodeRequest(smuggled, "bogus=1") + b"GET /health HTTP/1.1\r\n\r\n")
+
+        status, headers, body = await ReadResponse(reader)
+        self.assertEqual(status, 400)
+        self.assertIn(b"Unknown options", body)
+        self.assertEqual(headers["connection"], "close")
+        self.assertEqual(await reader.read(), b"")
+
+    async def test_full_lane_returns_429(self):
+        await self.HoldDispatchers()
+        data = ImageBytes(16, 16)
+
+        _, queuedWriter = await self.Connect()
+        queuedWriter.write(EncodeRequest(data))
+        await asyncio.wait_for(self.WaitQueued(small=1), 10)
+
+        reader, writer = await self.Connect()
+        writer.write(EncodeRequest(data))
+        status, headers, _ = await ReadResponse(reader)
+        self.assertEqual(status, 429)
+        self.assertEqual(headers["retry-after"], "1")
+
+        # the body was read, so the connection still serves requests
+        self.assertEqual(headers["connection"], "keep-alive")
+        writer.write(b"GET /health HTTP/1.1\r\n\r\n")
+        _, _, body = await ReadResponse(reader)
+        health = json.loads(body)
+        self.assertEqual(health["rejected"], 1)
+        self.assertEqual(health["queued"], {"small": 1, "large": 0})
+
+    async def test_small_images_go_first(self):
+        await self.HoldDispatchers()
+
+        largeReader, largeWriter = await self.Connect()
+        largeWriter.write(EncodeRequest(ImageBytes(96, 96)))
+        await asyncio.wait_for(self.WaitQueued(large=1), 10)
+        smallReader, smallWriter = await self.Connect()
+        smallWriter.write(EncodeRequest(ImageBytes(16, 16)))
+        await asyncio.wait_for(self.WaitQueued(small=1, large=1), 10)
+
+        self.ReleaseDispatcher()
+        small = asyncio.create_task(ReadResponse(smallReader))
+        large = asyncio.create_task(ReadResponse(largeReader))
+        done, _ = await asyncio.wait((small, large), timeout=60, return_when=asyncio.FIRST_COMPLETED)
+        self.assertEqual(done, {small})
+
+        for response in await asyncio.gather(small, large):
+            self.assertEqual(response[0], 200)
+            self.assertTrue(response[2].startswith(b"\xff\xd8"))
+
+    async def test_auto_dct_does_not_block_the_loop(self):
+        measuring = threading.Event()
+        def SlowAutoBackend():
+            measuring.wait(10)
+            return "numpy"
+
+        with mock.patch.object(dctbackends, "AutoBackend", mock.Mock(side_effect=SlowAutoBackend)) as autoBackend:
+            encodeReader, encodeWriter = await self.Connect()
+            encodeWriter.write(EncodeRequest(ImageBytes(16, 16), "dct=auto") + EncodeRequest(ImageBytes(16, 16), "dct=auto"))
+
+            # health is answered while the measurement is still running
+            reader, writer = await self.Connect()
+            writer.write(b"GET /health HTTP/1.1\r\n\r\n")
+            status, _, _ = await asyncio.wait_for(ReadResponse(reader), 5)
+            self.assertEqual(status, 200)
+
+            measuring.set()
+            for _ in range(2):
+                status, _, _ = await asyncio.wait_for(ReadResponse(encodeReader), 60)
+                self.assertEqual(status, 200)
+            autoBackend.assert_called_once()
+
+class LanesTest(unittest.IsolatedAsyncioTestCase):
+    async def test_small_only_slot_skips_large_images(self):
+        lanes = Lanes(maxQueue=1)
+        self.assertTrue(await lanes.Put("large", isSmall=False))
+        self.assertFalse(await lanes.Put("large", isSmall=False))
+
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(lanes.Take(smallOnly=True), 0.1)
+
+        self.assertTrue(await lanes.Put("small", isSmall=True))
+        self.assertEqual(await lanes.Take(smallOnly=True), "small")
+        self.assertEqual(await lanes.Take(), "large")
+
+if __name__ == "__main__":
+    unittest.main()